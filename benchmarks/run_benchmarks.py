@@ -0,0 +1,306 @@
+#! /usr/bin/python3
+"""
+Benchmark the network tools on synthetic networks (see synthetic_network.py)
+of increasing size.
+
+For each size, lsdtt-network-tool.py is run with --profile, giving the wall
+time and throughput (nodes per second) of each stage. Optionally, the path
+extraction and plots of lsdtt-channel-plotter.py are timed too. The network
+written is summarized (counts, stream orders, attribute sums and a hash of
+the topology) and checked against the golden summaries in golden.json.
+Stage throughputs are compared against those of an earlier run, if given,
+and any that have fallen by more than the tolerance are flagged (stages
+too quick to time reliably are not checked). upstream_topology is also
+timed on its worst case, a deep trunk, and its results checked. The exit
+status is 1 if any result differs from its golden summary (or the expected
+topology) or any stage has regressed.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import lsdtt_network
+import synthetic_network
+
+NETWORK_TOOL = os.path.join(REPO_DIR, 'lsdtt-network-tool.py')
+CHANNEL_PLOTTER = os.path.join(REPO_DIR, 'lsdtt-channel-plotter.py')
+GOLDEN = os.path.join(BENCHMARK_DIR, 'golden.json')
+
+
+def case_name(n_nodes, n_basins, channel_length, seed):
+    """Name of a benchmark case, as used for its files and golden entry."""
+    return ('synthetic_' + '%.0e' % n_nodes + '_b' + str(n_basins) + '_l'
+            + '%g' % channel_length + '_s' + str(seed)).replace('+', '')
+
+
+def network_summary(path):
+    """
+    Summary of the segments in a network GeoPackage, for comparison with
+    a golden one: counts, stream orders, sums of the numeric attributes,
+    and a hash of the segment IDs and links.
+    """
+    segments = lsdtt_network.read_gpkg(path, read_geometry=False)
+    topology = np.column_stack((segments['id'].values,
+                                segments['toseg'].values)).astype(np.int64)
+    return {
+        'segments': len(segments),
+        'mouths': int(np.sum(segments['toseg'].values == -1)),
+        'max_strahler': int(segments['strahler'].max()),
+        'max_shreve': int(segments['shreve'].max()),
+        'topology_sha1': hashlib.sha1(topology.tobytes()).hexdigest(),
+        'attribute_sums': {
+            column: float(segments[column].sum())
+            for column in segments.columns
+            if column not in ('id', 'toseg', 'fromseg', 'strahler',
+                              'shreve')
+            and np.issubdtype(segments[column].dtype, np.number)},
+        }
+
+
+def compare_summaries(summary, golden, rtol=1E-6):
+    """Differences between a network summary and a golden one, as text."""
+    differences = []
+    for key, expected in golden.items():
+        value = summary.get(key)
+        if key == 'attribute_sums':
+            for column, expected_sum in expected.items():
+                if column not in value:
+                    differences.append(column + ': missing')
+                elif not np.isclose(value[column], expected_sum, rtol=rtol):
+                    differences.append(column + ': ' + str(value[column])
+                                       + ' (golden: ' + str(expected_sum)
+                                       + ')')
+        elif value != expected:
+            differences.append(key + ': ' + str(value) + ' (golden: '
+                               + str(expected) + ')')
+    return differences
+
+
+def deep_trunk(n_segments):
+    """
+    toseg of the deepest network of (about) n_segments segments: a trunk
+    of half of them, every trunk segment below the first joined by a
+    tributary of a single segment.
+    """
+    n_trunk = (n_segments + 1) // 2
+    toseg = np.concatenate((np.arange(1, n_trunk + 1),
+                            np.arange(1, n_segments - n_trunk + 1)))
+    toseg[n_trunk - 1] = -1
+    return toseg
+
+
+def regressed_stages(stages, earlier_stages, tolerance, min_time):
+    """
+    The stages whose throughput has fallen by more than tolerance since an
+    earlier run, as dict of stage -> fractional fall, passing over stages
+    quicker than min_time [s] in both runs.
+    """
+    regressions = {}
+    for stage, timing in stages.items():
+        earlier = earlier_stages.get(stage)
+        if earlier is None or max(timing['wall_s'],
+                                  earlier['wall_s']) < min_time:
+            continue
+        rate = [k for k in timing if k.endswith('_per_s')][0]
+        if timing[rate] is not None and earlier.get(rate) \
+                and timing[rate] < (1 - tolerance) * earlier[rate]:
+            regressions[stage] = 1 - timing[rate] / earlier[rate]
+    return regressions
+
+
+def print_stages(stages, regressions):
+    """Print the time and throughput of each stage."""
+    for stage, timing in stages.items():
+        rate = [k for k in timing if k.endswith('_per_s')][0]
+        print('  %-24s %9.3f s %12s %s' % (
+                stage, timing['wall_s'],
+                '%.3g' % timing[rate] if timing[rate] else '-',
+                rate.replace('_per_s', '/s')
+                + ('  REGRESSED' if stage in regressions else '')))
+
+
+def run(command):
+    """Run a command, returning its wall time [s]."""
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark lsdtt-network-tool.py (and, optionally, lsdtt-channel-plotter.py) on synthetic networks, checking the results against golden summaries and flagging throughput regressions.')
+    parser.add_argument("--sizes", help="Comma-separated numbers of nodes (default: 1e4,1e5,1e6; up to 1e7 or more if memory allows)", type=str, default="1e4,1e5,1e6")
+    parser.add_argument("--basins", help="Number of basins (default: 10)", type=int, default=10)
+    parser.add_argument("--channel_length", help="Mean number of nodes per channel (default: 50)", type=float, default=50.)
+    parser.add_argument("--seed", help="Random seed (default: 0)", type=int, default=0)
+    parser.add_argument("--jobs", "-j", help="--jobs for lsdtt-network-tool.py (default: 1)", type=int, default=1)
+    parser.add_argument("--plots", action="store_true", help="Also time path extraction and plotting with lsdtt-channel-plotter.py (exports nodes, which is slower)")
+    parser.add_argument("--n_paths", help="Number of headwater paths to extract and plot with --plots (default: 10)", type=int, default=10)
+    parser.add_argument("--workdir", help="Directory for the synthetic inputs (kept for reuse) and outputs (default: lsdtt_benchmark)", type=str, default="lsdtt_benchmark")
+    parser.add_argument("--golden", help="Golden summaries (default: golden.json beside this script)", type=str, default=GOLDEN)
+    parser.add_argument("--update_golden", action="store_true", help="Record the summaries of this run as golden, rather than checking against them")
+    parser.add_argument("--baseline", help="Results JSON of an earlier run, against which to check stage throughputs", type=str)
+    parser.add_argument("--tolerance", help="Fractional fall in throughput flagged as a regression (default: 0.25)", type=float, default=0.25)
+    parser.add_argument("--min_time", help="Shortest stage wall time [s] checked for regressions (default: 0.05)", type=float, default=0.05)
+    parser.add_argument("--trunk_segments", help="Comma-separated numbers of segments in the deep-trunk networks on which to time upstream_topology (default: 2e4,1.6e5; empty for none)", type=str, default="2e4,1.6e5")
+    parser.add_argument("--output", help="Results JSON (default: <workdir>/results.json)", type=str)
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    output = args.output or os.path.join(args.workdir, 'results.json')
+    if os.path.exists(args.golden):
+        with open(args.golden) as f:
+            golden = json.load(f)
+    else:
+        golden = {}
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['cases']
+
+    results = {}
+    failures = []
+    for size in args.sizes.split(','):
+        n_nodes = int(float(size))
+        name = case_name(n_nodes, args.basins, args.channel_length,
+                         args.seed)
+        base = os.path.join(args.workdir, name)
+        print(name)
+
+        # Input, generated once and kept
+        if not os.path.exists(base + '.csv'):
+            start = time.perf_counter()
+            synthetic_network.write_csv(
+                synthetic_network.synthetic_node_table(
+                    n_nodes, args.basins, args.channel_length, args.seed),
+                base + '.csv')
+            print('  generated in %.1f s' % (time.perf_counter() - start))
+
+        # Network tool, stage by stage
+        for _path in (base + '.gpkg', base + '_nodes.gpkg'):
+            if os.path.exists(_path):
+                os.remove(_path)
+        wall = run([sys.executable, NETWORK_TOOL, base + '.csv',
+                    base + '.gpkg', '--profile', base + '_profile.json',
+                    '--jobs', str(args.jobs)]
+                   + (['--node_export'] if args.plots else []))
+        with open(base + '_profile.json') as f:
+            profile = json.load(f)
+        stages = {}
+        for stage, total in profile['stage_totals'].items():
+            stages[stage] = {'wall_s': total['wall_s'],
+                             'nodes_per_s': n_nodes / total['wall_s']
+                                            if total['wall_s'] > 0 else None}
+        stages['network tool (total)'] = {'wall_s': wall,
+                                          'nodes_per_s': n_nodes / wall}
+        result = {'nodes': n_nodes, 'stages': stages,
+                  'peak_rss_mb': profile['total']['peak_rss_mb'],
+                  'counts': profile['counts']}
+
+        # Channel plotter: many paths at once, and the whole network
+        if args.plots:
+            heads = lsdtt_network.headwater_rows(
+                        *[lsdtt_network.read_gpkg(
+                              base + '.gpkg', columns=['id', 'toseg'],
+                              read_geometry=False)[c].values
+                          for c in ('id', 'toseg')])
+            ids = ','.join(str(i) for i in heads[:args.n_paths])
+            _wall = run([sys.executable, CHANNEL_PLOTTER, base + '.gpkg',
+                         base + '_nodes.gpkg', '--ids', ids,
+                         '--paths_format', 'csv', '--lp',
+                         '--outbase', base])
+            stages['plotter: paths'] = {'wall_s': _wall,
+                                        'paths_per_s': args.n_paths / _wall}
+            _wall = run([sys.executable, CHANNEL_PLOTTER, base + '.gpkg',
+                         base + '_nodes.gpkg', '--lp_all',
+                         '--outbase', base])
+            stages['plotter: all'] = {'wall_s': _wall,
+                                      'nodes_per_s': n_nodes / _wall}
+
+        # Correctness
+        summary = network_summary(base + '.gpkg')
+        result['summary'] = summary
+        if args.update_golden:
+            golden[name] = summary
+        elif name in golden:
+            differences = compare_summaries(summary, golden[name])
+            result['golden'] = 'differs' if differences else 'matches'
+            for _difference in differences:
+                failures.append(name + ': ' + _difference)
+        else:
+            result['golden'] = 'none'
+
+        # Throughput regressions
+        regressions = regressed_stages(
+                        stages, baseline.get(name, {}).get('stages', {}),
+                        args.tolerance, args.min_time)
+        for stage, fall in regressions.items():
+            failures.append(name + ': ' + stage + ' throughput fell '
+                            + '%.0f%%' % (100 * fall))
+        result['regressions'] = list(regressions)
+
+        print_stages(stages, regressions)
+        print('  golden: ' + result.get('golden', 'updated'))
+        results[name] = result
+
+    # Stream order and upstream length down a deep trunk, whose every
+    # segment is a generation of its own
+    for size in filter(None, args.trunk_segments.split(',')):
+        n_segments = int(float(size))
+        name = 'deep_trunk_' + str(n_segments)
+        print(name)
+        toseg = deep_trunk(n_segments)
+        start = time.perf_counter()
+        topology = lsdtt_network.upstream_topology(toseg,
+                                                   np.ones(n_segments))
+        wall = time.perf_counter() - start
+        stages = {'upstream_topology': {
+                    'wall_s': wall, 'segments_per_s': n_segments / wall}}
+        mouth = np.flatnonzero(toseg == -1)[0]
+        expected = {'max_strahler': 2, 'mouth_shreve': (n_segments + 1) // 2,
+                    'mouth_upstream_length': float(n_segments)}
+        found = {'max_strahler': int(topology['strahler'].max()),
+                 'mouth_shreve': int(topology['shreve'][mouth]),
+                 'mouth_upstream_length':
+                    float(topology['upstream_length'][mouth])}
+        for key in expected:
+            if found[key] != expected[key]:
+                failures.append(name + ': ' + key + ': ' + str(found[key])
+                                + ' (expected: ' + str(expected[key]) + ')')
+        regressions = regressed_stages(
+                        stages, baseline.get(name, {}).get('stages', {}),
+                        args.tolerance, args.min_time)
+        for stage, fall in regressions.items():
+            failures.append(name + ': ' + stage + ' throughput fell '
+                            + '%.0f%%' % (100 * fall))
+        print_stages(stages, regressions)
+        print('  topology: ' + ('matches' if found == expected
+                                else 'differs'))
+        results[name] = {'segments': n_segments, 'stages': stages,
+                         'topology': found,
+                         'regressions': list(regressions)}
+
+    with open(output, 'w') as f:
+        json.dump({'argv': sys.argv, 'versions': profile.get('versions'),
+                   'cases': results}, f, indent=2)
+    print("Results written to", output)
+    if args.update_golden:
+        with open(args.golden, 'w') as f:
+            json.dump(golden, f, indent=2, sort_keys=True)
+        print("Golden summaries written to", args.golden)
+
+    if failures:
+        print(str(len(failures)) + " failure(s):")
+        for _failure in failures:
+            print("  " + _failure)
+        sys.exit(1)
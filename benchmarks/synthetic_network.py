@@ -0,0 +1,199 @@
+#! /usr/bin/python3
+"""
+Random dendritic drainage networks in the layout of LSDTopoTools outputs,
+for benchmarking the network tools without real data.
+
+Each basin is grown from a main stem: every further channel (source key)
+starts at its own channel head and drains into a random node of a channel
+before it in the same basin. Channel lengths are geometrically distributed
+about a mean, which sets how branching the network is. Flow distance,
+drainage area and chi are then accumulated along the flow paths, and
+elevation follows chi at a random steepness (m_chi) for each channel, so
+that the files behave like real ones.
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+
+# Column order of the two LSDTopoTools outputs
+MCHISEGMENTED_COLUMNS = ['latitude', 'longitude', 'chi', 'elevation',
+                         'flow_distance', 'drainage_area', 'm_chi', 'b_chi',
+                         'source_key', 'basin_key', 'segmented_elevation',
+                         'node', 'receiver_node']
+CHI_DATA_MAP_COLUMNS = ['latitude', 'longitude', 'chi', 'elevation',
+                        'flow_distance', 'drainage_area', 'source_key',
+                        'basin_key', 'NI', 'receiver_NI']
+
+
+def synthetic_node_table(n_nodes, n_basins=1, mean_channel_length=50,
+                         seed=0, cell_size=30., theta=0.45,
+                         threshold_area=1E5):
+    """
+    A random network of n_nodes nodes in n_basins basins, as a dict of
+    "*_MChiSegmented.csv" column -> array, with the nodes of each channel
+    listed from its head downstream. Channel heads drain threshold_area
+    [m2], and each node adds the hillslope area of ten cells. The same
+    arguments always give the same network.
+    """
+    rng = np.random.default_rng(seed)
+    n_nodes = int(n_nodes)
+    mean_channel_length = max(float(mean_channel_length), 2.)
+
+    # Channel lengths (at least two nodes each), cut to n_nodes in all
+    lengths = 1 + rng.geometric(1. / (mean_channel_length - 1.),
+                                size=int(n_nodes / mean_channel_length
+                                         * 1.5) + 10)
+    while lengths.sum() < n_nodes:
+        lengths = np.concatenate((lengths, 1 + rng.geometric(
+                                    1. / (mean_channel_length - 1.),
+                                    size=len(lengths))))
+    n_channels = np.searchsorted(np.cumsum(lengths), n_nodes) + 1
+    lengths = lengths[:n_channels]
+    lengths[-1] -= lengths.sum() - n_nodes
+    if lengths[-1] < 2:
+        lengths[-2] += lengths[-1]
+        lengths = lengths[:-1]
+    n_channels = len(lengths)
+    if n_channels < n_basins:
+        raise ValueError("Too few nodes for " + str(n_basins) + " basins")
+    starts = np.concatenate(([0], np.cumsum(lengths)))
+
+    # Basins are runs of channels, the first of each being its main stem
+    channel_basin = np.repeat(np.arange(n_basins),
+                              [len(c) for c in np.array_split(
+                                  np.arange(n_channels), n_basins)])
+    first_channel = np.searchsorted(channel_basin, channel_basin)
+    basin_start = starts[first_channel]
+
+    # Each other channel drains into a random node, not a channel head, of
+    # an earlier channel in its basin
+    junction = basin_start + np.floor(rng.random(n_channels)
+                                      * (starts[:-1] - basin_start)) \
+                                .astype(np.int64)
+    junction += np.isin(junction, starts)
+    # and, where the main stem is long enough, not into a mouth
+    ends = starts[1:] - 1
+    is_main_stem = first_channel == np.arange(n_channels)
+    junction = np.where(np.isin(junction, ends[is_main_stem])
+                        & ~np.isin(junction - 1, starts),
+                        junction - 1, junction)
+    junction[is_main_stem] = -1
+
+    node_channel = np.repeat(np.arange(n_channels), lengths)
+    receiver = np.arange(1, n_nodes + 1)
+    receiver[ends] = np.where(junction >= 0, junction, ends)
+
+    # Distance from each node to its receiver: straight or diagonal cells
+    step = cell_size * np.where(rng.random(n_nodes) < 0.4, np.sqrt(2.), 1.)
+
+    # Drainage area, accumulated downstream. Channels only drain into
+    # earlier ones, so taking them in reverse sees every tributary first.
+    area = np.full(n_nodes, 10 * cell_size**2)
+    area[starts[:-1]] = threshold_area
+    for k in range(n_channels - 1, -1, -1):
+        channel = area[starts[k]:starts[k+1]]
+        np.cumsum(channel, out=channel)
+        if junction[k] >= 0:
+            area[junction[k]] += channel[-1]
+
+    # Steepness of each channel, and the node values of m_chi about it
+    ksn = np.exp(rng.normal(np.log(30.), 0.5, size=n_channels))
+    m_chi = ksn[node_channel] * np.exp(rng.normal(0., 0.1, size=n_nodes))
+    dchi = step * (1. / area)**theta
+
+    # Flow distance, chi, elevation and position, accumulated upstream
+    # from each mouth, channel by channel in order
+    heading = rng.uniform(0., 2*np.pi, size=n_channels)
+    angle = heading[node_channel] + rng.normal(0., 0.4, size=n_nodes)
+    dx = step * np.cos(angle)
+    dy = step * np.sin(angle)
+    dz = dchi * m_chi
+    basin_x = np.arange(n_basins) * 50000.
+    accumulated = {}
+    for name, increments in (('flow_distance', step), ('chi', dchi),
+                             ('elevation', dz), ('x', dx), ('y', dy)):
+        values = np.empty(n_nodes)
+        for k in range(n_channels):
+            s, e = starts[k], starts[k+1]
+            upstream = np.cumsum(increments[s:e][::-1])[::-1]
+            if junction[k] >= 0:
+                values[s:e] = values[junction[k]] + upstream
+            else:
+                # The mouth is the last node of the main stem
+                values[s:e] = upstream - upstream[-1]
+        accumulated[name] = values
+    mouth_z = rng.uniform(100., 500., size=n_basins)
+    accumulated['elevation'] += mouth_z[channel_basin[node_channel]]
+    accumulated['x'] += basin_x[channel_basin[node_channel]]
+
+    lat0 = 45.
+    latitude = lat0 + accumulated['y'] / 111320.
+    longitude = -90. + accumulated['x'] / (111320. * np.cos(np.radians(lat0)))
+
+    # Raster-cell-like node IDs
+    node = 1000 + 3 * rng.permutation(n_nodes).astype(np.int64)
+    b_chi = accumulated['elevation'] - m_chi * accumulated['chi']
+    return {
+        'latitude': latitude,
+        'longitude': longitude,
+        'chi': accumulated['chi'],
+        'elevation': accumulated['elevation'],
+        'flow_distance': accumulated['flow_distance'],
+        'drainage_area': area,
+        'm_chi': m_chi,
+        'b_chi': b_chi,
+        'source_key': node_channel.astype(np.int32),
+        'basin_key': channel_basin[node_channel].astype(np.int32),
+        'segmented_elevation': b_chi + m_chi * accumulated['chi'],
+        'node': node,
+        'receiver_node': node[receiver],
+        }
+
+
+def write_csv(node_table, path, schema='MChiSegmented'):
+    """
+    Write a node table (as given by synthetic_node_table) as a
+    "*_MChiSegmented.csv" or, if schema is 'chi_data_map', as a
+    "*_chi_data_map.csv", through pyarrow if it is installed.
+    """
+    if schema == 'chi_data_map':
+        columns = CHI_DATA_MAP_COLUMNS
+        table = dict(node_table, NI=node_table['node'],
+                     receiver_NI=node_table['receiver_node'])
+    else:
+        columns = MCHISEGMENTED_COLUMNS
+        table = node_table
+    try:
+        import pyarrow as pa
+        import pyarrow.csv
+    except ImportError:
+        import pandas as pd
+        pd.DataFrame({c: table[c] for c in columns}).to_csv(path,
+                                                             index=False)
+    else:
+        # With an unquoted header, as LSDTopoTools writes it
+        with open(path, 'wb') as f:
+            f.write((','.join(columns) + '\n').encode())
+            pyarrow.csv.write_csv(pa.table({c: table[c] for c in columns}),
+                                  f, pyarrow.csv.WriteOptions(
+                                        include_header=False,
+                                        quoting_style='none'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a random dendritic drainage network as an LSDTopoTools "*_MChiSegmented.csv" (or "*_chi_data_map.csv"), for benchmarking.')
+    parser.add_argument("file_output", help="Filename for the output CSV", type=str)
+    parser.add_argument("--nodes", help="Number of nodes (default: 100000; e.g., 1e6)", type=float, default=1E5)
+    parser.add_argument("--basins", help="Number of basins (default: 10)", type=int, default=10)
+    parser.add_argument("--channel_length", help="Mean number of nodes per channel (source key); smaller values give more branching networks (default: 50)", type=float, default=50.)
+    parser.add_argument("--seed", help="Random seed (default: 0)", type=int, default=0)
+    parser.add_argument("--schema", help="Output layout (default: MChiSegmented)", choices=['MChiSegmented', 'chi_data_map'], default='MChiSegmented')
+    args = parser.parse_args()
+
+    write_csv(synthetic_node_table(args.nodes, args.basins,
+                                   args.channel_length, args.seed),
+              args.file_output, args.schema)
+    print("Network written to", os.path.abspath(args.file_output))
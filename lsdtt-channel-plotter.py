@@ -1,11 +1,12 @@
 #! /usr/bin/python3
 
 import argparse
-import pandas as pd
-import geopandas as gpd
 import numpy as np
-from matplotlib import pyplot as plt
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import lsdtt_network
 
 ##########
 # PARSER #
@@ -15,9 +16,16 @@ import sys
 parser = argparse.ArgumentParser(description='Plot channel long profile and/or map view, optionally higlighting a channel starting from a provided segment id.')
 parser.add_argument("segments", help="Path to geopackage file with segments (output from lsdtt-network-tool)", type=str)
 parser.add_argument("nodes", help="Path to geopackage file with nodes (output from lsdtt-network-tool)", type=str)
+parser.add_argument("--layer", help='Layer of the segment and node geopackages to read, e.g., "basin_<key>" for one basin of those written by lsdtt-network-tool with several basin keys (default: the first layer)', type=str)
 parser.add_argument("--id", help="segment id (see attribute table) of the upstream-most segment of the flow path to plot and/or highlight", type=int)
+parser.add_argument("--ids", help='Segment ids of the upstream-most segments of many flow paths to extract in one pass: a comma-separated list, a file of ids (separated by commas, spaces or new lines), or "heads" for every channel head (segments that nothing drains into). Paths are written with --outbase; see --paths_format', type=str)
+parser.add_argument("--paths_format", help='Output for --ids: "gpkg" (default) writes the segments of each path to its own layer, "path_<id>", of <outbase>_Paths.gpkg; "csv" writes the nodes of every path, with the starting id in a "path_id" column, to <outbase>_Paths.csv', type=str, choices=['gpkg', 'csv'], default='gpkg')
+parser.add_argument("--jobs", "-j", help="Number of worker processes across which to divide the plots (--lp, --lp_combined) made for each path of --ids; these are drawn off screen and written as <outbase>_<id>_<plot>.<outfmt> (default: 1)", type=int, default=1)
 parser.add_argument("--outbase", help="Base name for the output plots; can include full path, and otherwise will be assumed to be local; an underscore will be appended to the end of this", type=str)
 parser.add_argument("--outfmt", help="File-extension-coded format for the output plots; if not set, plots may be displayed but not saved; defaults to 'png'", type=str, default='png')
+parser.add_argument("--cache", action="store_true", help="Keep binary copies of the segment and node geopackages (by default, in a " + lsdtt_network.CACHE_DIRNAME + " directory next to the segments), so that later runs skip reading them")
+parser.add_argument("--cache_dir", help="Directory for the cache; implies --cache", type=str)
+parser.add_argument("--cache_max_size", help="Size [MB] above which the least recently used cache entries are deleted (default: 10000)", type=float, default=10000.)
 #parser.add_argument("river_name", help="name of the river (used for title of plots)", type=str)
 
 # OUTPUT
@@ -27,6 +35,7 @@ parser.add_argument("-p", "--lp", help="Flag: Plot long profile starting from ID
 parser.add_argument("-a", "--lp_all", help="Flag: Plot long profile of all streams", action="store_true")
 parser.add_argument("-c", "--lp_combined", help="Flag: Plot long profiles of all streams with the portion starting from ID highlighted", action="store_true")
 parser.add_argument("-k", "--ksn", help="Flag: Plot ksn on long profile", action="store_true")
+parser.add_argument("--render", help='How to draw the long profiles of all streams (for --lp_all and --lp_combined): "vector" (default) draws every segment as a line; "rasterized" does too, but stores them as an image within vector output formats (e.g., svg, pdf), keeping files small; "density" draws the number of nodes per pixel, for very large networks', type=str, choices=['vector', 'rasterized', 'density'], default='vector')
 parser.add_argument("-s", "--show", help="Flag: Display plot(s) on screen", action="store_true")
 # Flag for selected channel output
 parser.add_argument("-g", "--geopackage", help="Flag: Export geopackage of selected channel for plotting in GIS", action="store_true")
@@ -34,20 +43,36 @@ parser.add_argument("-g", "--geopackage", help="Flag: Export geopackage of selec
 # PARSE
 args = parser.parse_args()
 
+# Only now import the heavy libraries, so that --help (and any argument
+# error) comes back at once
+import pandas as pd
+from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm
+
 # Standard arguments
 #Input selected segment_ID. This will be the start of the path.
 input_segment_id = args.id
 input_segments = args.segments
 input_nodes = args.nodes
+input_layer = args.layer
 #river_name = args.river_name
 outbase = args.outbase
 outfmt = args.outfmt
+if args.cache_dir is not None:
+    cache_dir = args.cache_dir
+elif args.cache:
+    cache_dir = lsdtt_network.default_cache_dir(input_segments)
+else:
+    cache_dir = None
+cache_max_size = args.cache_max_size * 1E6
 
 # Flags
 _plot_selected_lp = args.lp
 _plot_all_lps = args.lp_all
 _plot_combined = args.lp_combined
 _plot_ksn = args.ksn
+render = args.render
 _plot_show = args.show
 _write_geopackage = args.geopackage
 
@@ -72,12 +97,12 @@ _write_geopackage = True
 ##############################
 
 if _plot_selected_lp:
-    if input_segment_id is None:
-        print('For --lp, --id is required')
+    if input_segment_id is None and args.ids is None:
+        print('For --lp, --id or --ids is required')
         sys.exit(2)
 if _plot_combined:
-    if input_segment_id is None:
-        print('For --lp-combined, --id is required')
+    if input_segment_id is None and args.ids is None:
+        print('For --lp-combined, --id or --ids is required')
         sys.exit(2)
 
 if _write_geopackage:
@@ -88,6 +113,11 @@ if _write_geopackage:
         print('For --geopackage, --outbase is required')
         sys.exit(2)
 
+if args.ids is not None:
+    if outbase is None:
+        print('For --ids, --outbase is required')
+        sys.exit(2)
+
 if _plot_selected_lp or _plot_all_lps or _plot_combined:
     if input_nodes is None:
         print('For any plotting request, a node-input file is required')
@@ -97,96 +127,161 @@ if _plot_selected_lp or _plot_all_lps or _plot_combined:
 # READ INPUT #
 ##############
 
-dfsegs = gpd.read_file(input_segments)
-dfnodes = gpd.read_file(input_nodes)
-
-#Find out if the input segment is in the segments dataframe.
-input_segment_id_found = False
-for seg_id in dfsegs['id']:
-    if seg_id == input_segment_id:
-        input_segment_id_found = True
-        print("Segment ID found.")
-
-#We'll probably want this to raise an exception so that it doesn't continue with the pathmaking if the given ID doesn't exist
-# for right now, though, we'll just print a message
-
-if not input_segment_id_found:
-    print("Error: No segment with the given ID")
-
-
-#Begin to generate path.
-#convert input to int
-input_segment_id= int(input_segment_id)
-
-#Look up user input seg id, create column is_input w/true and false
-dfsegs['is_input'] = np.where(dfsegs['id']== input_segment_id, True, False)
-
-#Create new df called dfpath that is populated by all the true values.
-dfpath = dfsegs[dfsegs['is_input'] == True]
-
-
-#Create the path
-#Set input_toseg to the input_segment_id
-#Does this generate a duplicate of the first segment?
-input_toseg = input_segment_id
-while input_toseg != -1:
-    #find relevant toseg
-    input_toseg=dfpath.loc[dfpath['id']== input_segment_id, 'toseg']
-    #convert to int
-    input_toseg=int(input_toseg)
-    #query dfsegs to find the segment with the same id as toseg
-    dfsegs['is_input'] = np.where(dfsegs['id']== input_toseg, True, False)
-    #take this line ad append it to dfpath
-    dfpath = dfpath.append(dfsegs[dfsegs['is_input'] == True])
-    input_segment_id = input_toseg
-#print(dfpath)
-
-#Now have a df that has all the relevant segments, in order moving down path.
-
-#Begin pulling required nodes from segments
-#Create list of relevant segments
-queried_segments = []
-queried_segments_idx = []
-for seg_id in dfpath['id']:
-    queried_segments.append(seg_id)
-    queried_segments_idx.append(dfsegs.index[dfsegs['id'] == seg_id][0])
-
-#Create list of df entries for relevant nodes in queried_segments
-"""
-# Approach querying the network
-path_nodes=[]
-for _id in queried_segments:
-    _seg = dfsegs.geometry[dfsegs['id'] == _id]
-    _xyz = np.array(_seg[_seg.index[0]].coords[:])
-    _
-"""
-    
-# Approach with nodes already printed
-path_nodes=[]
-for _id in queried_segments:
-    path_nodes.append(dfnodes[dfnodes['segment_id'] == _id] )
-
-#Create a df with relevant nodes in path
-dfpath_nodes = pd.concat(path_nodes, ignore_index=True)
-
-#dfpath_nodes
-
+# Read only what is needed: the segment topology (ids, no geometry) to
+# find the path(s), and then only the nodes (and segments) along them.
+# Just the columns that the plots use are read from the nodes (m_chi only
+# to plot ksn).
+NODE_PLOT_COLUMNS = ['segment_id', 'flow_distance', 'elevation'] \
+                    + (['m_chi'] if _plot_ksn else [])
+
+def read_nodes(ids=None, columns=NODE_PLOT_COLUMNS):
+    return lsdtt_network.read_gpkg(input_nodes, columns=columns, ids=ids,
+                                   id_column='segment_id',
+                                   read_geometry=False,
+                                   cache_dir=cache_dir,
+                                   max_bytes=cache_max_size,
+                                   layer=input_layer)
+
+def read_segments(ids):
+    # Full segment features, in the order of ids
+    _segs = lsdtt_network.read_gpkg(input_segments, ids=ids,
+                                    cache_dir=cache_dir,
+                                    max_bytes=cache_max_size,
+                                    layer=input_layer)
+    return _segs.iloc[pd.Index(_segs['id']).get_indexer(ids)]
+
+dfsegs = lsdtt_network.read_gpkg(input_segments, columns=['id', 'toseg'],
+                                 read_geometry=False, cache_dir=cache_dir,
+                                 max_bytes=cache_max_size, layer=input_layer)
+
+# The long profiles of the whole network need every node
+if _plot_all_lps or _plot_combined:
+    dfnodes = read_nodes()
+
+# Index the segments by ID, and link each to the row of the segment that
+# it drains into
+segment_rows_by_id = pd.Index(dfsegs['id'])
+toseg_rows = lsdtt_network.toseg_rows(dfsegs['id'], dfsegs['toseg'])
+
+if input_segment_id is not None:
+    #Find out if the input segment is in the segments dataframe.
+    input_segment_id = int(input_segment_id)
+    if input_segment_id not in segment_rows_by_id:
+        print("Error: No segment with the given ID")
+        sys.exit(2)
+    print("Segment ID found.")
+
+    #Create the path: the rows of all the relevant segments, in order
+    #moving down path.
+    queried_segments_idx = lsdtt_network.downstream_path(
+                            toseg_rows,
+                            segment_rows_by_id.get_loc(input_segment_id))
+    queried_segments = dfsegs['id'].values[queried_segments_idx]
+
+    #Read the nodes of these segments, grouping the node rows by segment
+    #ID once rather than searching the node table for each segment
+    dfpath_src = read_nodes(queried_segments)
+    node_rows_by_segment = dfpath_src.groupby('segment_id',
+                                              sort=False).indices
+
+    #Create a df with relevant nodes in path
+    dfpath_nodes = dfpath_src.iloc[np.concatenate(
+                        [node_rows_by_segment[_id]
+                         for _id in queried_segments
+                         if _id in node_rows_by_segment])] \
+                    .reset_index(drop=True)
+
+if args.ids is not None:
+    # Many paths at once
+    if args.ids == 'heads':
+        path_start_idx = lsdtt_network.headwater_rows(dfsegs['id'],
+                                                      dfsegs['toseg'])
+    else:
+        if os.path.isfile(args.ids):
+            with open(args.ids) as f:
+                _ids = f.read()
+        else:
+            _ids = args.ids
+        _ids = [int(_id) for _id in _ids.replace(',', ' ').split()]
+        path_start_idx = segment_rows_by_id.get_indexer(_ids)
+        if (path_start_idx == -1).any():
+            print("Error: No segment with the given ID(s): "
+                  + str(list(np.array(_ids)[path_start_idx == -1])))
+            sys.exit(2)
+    path_offsets, path_segments_idx = lsdtt_network.downstream_paths(
+                                        toseg_rows, path_start_idx)
+    path_ids = dfsegs['id'].values[path_start_idx]
+
+    if args.paths_format == 'gpkg':
+        # Full features of every segment on any of the paths, in order of
+        # their rows in dfsegs
+        _needed_idx = np.unique(path_segments_idx)
+        dfpath_segs = read_segments(dfsegs['id'].values[_needed_idx])
+        for i, _path_id in enumerate(path_ids):
+            _idx = path_segments_idx[path_offsets[i]:path_offsets[i+1]]
+            lsdtt_network.write_gpkg(
+                dfpath_segs.iloc[np.searchsorted(_needed_idx, _idx)],
+                outbase+'_Paths.gpkg', layer='path_'+str(_path_id))
+        print(str(len(path_ids)) + ' paths written to '
+              + outbase+'_Paths.gpkg')
+
+    if args.paths_format == 'csv' or _plot_selected_lp or _plot_combined:
+        # The nodes of the paths, read once for all of them: every column
+        # for the csv output, or else just those plotted, which are already
+        # at hand if the whole network has been read
+        _path_segment_ids = dfsegs['id'].values[path_segments_idx]
+        if args.paths_format == 'csv':
+            dfpaths_src = read_nodes(np.unique(_path_segment_ids),
+                                     columns=None)
+        elif _plot_all_lps or _plot_combined:
+            dfpaths_src = dfnodes
+        else:
+            dfpaths_src = read_nodes(np.unique(_path_segment_ids))
+        paths_node_rows = dfpaths_src.groupby('segment_id',
+                                              sort=False).indices
+        _no_rows = np.array([], dtype=int)
+
+        def path_nodes(i):
+            """
+            The nodes of path i of --ids, in order moving down it
+            """
+            _ids = _path_segment_ids[path_offsets[i]:path_offsets[i+1]]
+            return dfpaths_src.iloc[np.concatenate(
+                        [paths_node_rows.get(_id, _no_rows)
+                         for _id in _ids])] \
+                    .reset_index(drop=True)
+
+    if args.paths_format == 'csv':
+        # The nodes of each path, in order, labelled by the starting id
+        _node_rows = [paths_node_rows.get(_id, _no_rows)
+                      for _id in _path_segment_ids]
+        _path_lengths = np.add.reduceat(
+                            [len(_rows) for _rows in _node_rows],
+                            path_offsets[:-1]) \
+                        if len(_node_rows) else np.array([], dtype=int)
+        dfpaths = dfpaths_src.iloc[np.concatenate(_node_rows)]
+        dfpaths.insert(0, 'path_id', np.repeat(path_ids, _path_lengths))
+        dfpaths.to_csv(outbase+'_Paths.csv', index=False)
+        print(str(len(path_ids)) + ' paths written to '
+              + outbase+'_Paths.csv')
 
 #####################
 # Geopackage output #
 #####################
 
 if _write_geopackage:
-    path_selected = dfsegs.loc[queried_segments_idx]
+    path_selected = read_segments(queried_segments)
     path_selected.to_file(outbase+'_SelectedChannel.gpkg', driver="GPKG")
 
 #########
 # Plots #
 #########
 
-# Only one (selected) long profile
-if _plot_selected_lp:
-    plt.figure(figsize=(9,5))
+def plot_long_profile(dfpath_nodes, filename=None):
+    """
+    Only one (selected) long profile
+    """
+    fig = plt.figure(figsize=(9,5))
     if _plot_ksn:
         plt.plot((dfpath_nodes['flow_distance']/1000), dfpath_nodes['elevation'], '.5', linewidth=4)
         sc = plt.scatter((dfpath_nodes['flow_distance']/1000), dfpath_nodes['elevation'], c=np.log10(dfpath_nodes['m_chi']), cmap='magma', s=16, zorder=999999)
@@ -198,17 +293,44 @@ if _plot_selected_lp:
     plt.xlabel('Upchannel Distance [km]', fontsize=16)
     plt.ylabel('Elevation Above Mouth [m]', fontsize=16)
     plt.tight_layout()
-    if outbase is not None:
-        plt.savefig(outbase+'_LongProfile.'+outfmt, dpi=300,
+    if filename is not None:
+        plt.savefig(filename, dpi=300,
                 facecolor='w', edgecolor='w',
                 orientation='portrait', transparent=False)
-
-# All long profiles with selected one highlighted
-if _plot_combined:
-    plt.figure(figsize=(9,5))
-    for seg, nodes_segs in dfnodes.groupby('segment_id'):
-        plt.plot((nodes_segs['flow_distance']/1000), nodes_segs['elevation'],
-                  color='gray', linewidth=1)
+    return fig
+
+def plot_all_long_profiles(dfnodes, render='vector'):
+    """
+    Draw the long profiles of all segments in gray, as one LineCollection
+    (rasterized within vector output files if render is 'rasterized'), or,
+    if render is 'density', as an image of the number of nodes per pixel,
+    which stays quick and small however large the network.
+    """
+    _x = dfnodes['flow_distance'].values/1000
+    _z = dfnodes['elevation'].values
+    ax = plt.gca()
+    if render == 'density':
+        _counts, _xedges, _zedges = np.histogram2d(_x, _z, bins=(900, 500))
+        ax.imshow(_counts.T, origin='lower', aspect='auto',
+                  extent=(_xedges[0], _xedges[-1], _zedges[0], _zedges[-1]),
+                  cmap='Greys', norm=LogNorm(vmin=1), interpolation='nearest')
+    else:
+        # Split the nodes, in their export order within each segment, into
+        # one line per segment
+        _segment_ids = dfnodes['segment_id'].values
+        _order = np.argsort(_segment_ids, kind='stable')
+        _breaks = np.flatnonzero(np.diff(_segment_ids[_order])) + 1
+        _lines = np.split(np.column_stack((_x, _z))[_order], _breaks)
+        ax.add_collection(LineCollection(_lines, colors='gray', linewidths=1,
+                                         rasterized=(render == 'rasterized')))
+        ax.autoscale_view()
+
+def plot_combined(dfnodes, dfpath_nodes, filename=None):
+    """
+    All long profiles with selected one highlighted
+    """
+    fig = plt.figure(figsize=(9,5))
+    plot_all_long_profiles(dfnodes, render)
     #plt.title(river_name, fontdict=None, loc='center', pad=None)
     plt.xlabel('Upchannel Distance [km]')
     plt.ylabel('Elevation Above Mouth [m]')
@@ -225,40 +347,96 @@ if _plot_combined:
     plt.xlabel('Upchannel Distance [km]', fontsize=16)
     plt.ylabel('Elevation Above Mouth [m]', fontsize=16)
     plt.tight_layout()
-    if outbase is not None:
-        plt.savefig(outbase+'_LongProfiles_AllWithHighlight.'+outfmt, dpi=300,
+    if filename is not None:
+        plt.savefig(filename, dpi=300,
                 facecolor='w', edgecolor='w',
                 orientation='portrait', transparent=False)
-
-# All long profiles
-if _plot_all_lps:
-    plt.figure(figsize=(9,5))
-    for seg, nodes_segs in dfnodes.groupby('segment_id'):
-        plt.plot((nodes_segs['flow_distance']/1000), nodes_segs['elevation'],
-        color= 'gray', linewidth=1)
+    return fig
+
+def plot_all(dfnodes, filename=None):
+    """
+    All long profiles
+    """
+    fig = plt.figure(figsize=(9,5))
+    plot_all_long_profiles(dfnodes, render)
     if _plot_ksn:
-        # First, find full range of ksn
-        _ksn_max = -1E16
-        _ksn_min = 1E16
-        for seg, nodes_segs in dfnodes.groupby('segment_id'):
-            _ksn_max = np.max((_ksn_max, np.max(nodes_segs['m_chi'])))
-            _ksn_min = np.min((_ksn_min, np.min(nodes_segs['m_chi'])))
-        # Then plot
-        for seg, nodes_segs in dfnodes.groupby('segment_id'):
-            sc = plt.scatter((nodes_segs['flow_distance']/1000), nodes_segs['elevation'],
-                               c=np.log10(nodes_segs['m_chi']), cmap='magma', s=1,
-                               vmax=np.log10(_ksn_max), vmin=np.log10(_ksn_min),
-                               zorder=999999)
+        # Plot all nodes at once, over the full range of ksn
+        _log_ksn = np.log10(dfnodes['m_chi'].values)
+        _finite = np.isfinite(_log_ksn)
+        sc = plt.scatter((dfnodes['flow_distance']/1000), dfnodes['elevation'],
+                         c=_log_ksn, cmap='magma', s=1,
+                         vmax=np.max(_log_ksn[_finite]),
+                         vmin=np.min(_log_ksn[_finite]),
+                         zorder=999999, rasterized=(render != 'vector'))
         cbar = plt.colorbar(sc, label='log$_{10} (k_{sn})$')#, fontsize=16)
         cbar.set_label(label='log$_{10} (k_{sn})$', fontsize=16)
     plt.gca().invert_xaxis()
     plt.xlabel('Upchannel Distance [km]', fontsize=16)
     plt.ylabel('Elevation Above Mouth [m]', fontsize=16)
     plt.tight_layout()
-    if outbase is not None:
-        plt.savefig(outbase+'_LongProfiles_All.'+outfmt, dpi=300,
+    if filename is not None:
+        plt.savefig(filename, dpi=300,
                 facecolor='w', edgecolor='w',
                 orientation='portrait', transparent=False)
+    return fig
+
+def plot_path(i):
+    """
+    Write the per-path plots for path i of --ids, named by the id of the
+    segment at which it starts, and close them.
+    """
+    _path_nodes = path_nodes(i)
+    _outbase = outbase+'_'+str(path_ids[i])
+    if _plot_selected_lp:
+        plt.close(plot_long_profile(_path_nodes,
+                                    _outbase+'_LongProfile.'+outfmt))
+    if _plot_combined:
+        plt.close(plot_combined(dfnodes, _path_nodes,
+                    _outbase+'_LongProfiles_AllWithHighlight.'+outfmt))
+    return path_ids[i]
+
+def _plot_worker_init():
+    # Workers draw off screen
+    plt.switch_backend('Agg')
+
+def _outname(suffix):
+    if outbase is not None:
+        return outbase+suffix+outfmt
+
+if input_segment_id is not None:
+    if _plot_selected_lp:
+        plot_long_profile(dfpath_nodes, _outname('_LongProfile.'))
+    if _plot_combined:
+        plot_combined(dfnodes, dfpath_nodes,
+                      _outname('_LongProfiles_AllWithHighlight.'))
+
+# The same plots for every path of --ids. The data are loaded once (above);
+# forked worker processes inherit them, and so each only draws and saves.
+if args.ids is not None and (_plot_selected_lp or _plot_combined):
+    if not _plot_show:
+        plt.switch_backend('Agg')
+    _jobs = min(args.jobs, len(path_ids))
+    _mp_context = lsdtt_network.fork_context()
+    if _jobs > 1 and _mp_context is not None:
+        with ProcessPoolExecutor(max_workers=_jobs,
+                                 mp_context=_mp_context,
+                                 initializer=_plot_worker_init) as executor:
+            # Small chunks keep the workers evenly loaded
+            _chunksize = max(1, min(16, len(path_ids) // (4*_jobs)))
+            for _path_id in executor.map(plot_path, range(len(path_ids)),
+                                         chunksize=_chunksize):
+                pass
+    else:
+        if _jobs > 1:
+            print('Parallel plotting needs the "fork" start method; '
+                  'plotting serially')
+        for i in range(len(path_ids)):
+            plot_path(i)
+    print('Plots for ' + str(len(path_ids)) + ' paths written with '
+          + outbase+'_<id>_')
+
+if _plot_all_lps:
+    plot_all(dfnodes, _outname('_LongProfiles_All.'))
 
 """
 # Profile of entire network (selected path in black)
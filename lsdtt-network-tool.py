@@ -1,19 +1,33 @@
 #! /usr/bin/python3
 
 import argparse
-import pandas as pd
+import hashlib
+import json
 import numpy as np
-from scipy.optimize import curve_fit
-import geopandas as gpd
-from shapely.geometry import LineString
 import os
+import sys
+
+import lsdtt_network
 
 # Create possible command line arguments
 parser = argparse.ArgumentParser(description='build a vectorized drainage network from LSDTopoTools outputs, divided at tributary junctions.')
-parser.add_argument("file_input", help='LSDTopoTools "*_MChiSegmented.csv" output used to build the drainage network', type=str)
+parser.add_argument("file_input", help='LSDTopoTools "*_MChiSegmented.csv" or "*_chi_data_map.csv" output used to build the drainage network (recognized from its columns; a chi_data_map needs the "NI" and "receiver_NI" columns, and has no "m_chi" for ksn)', type=str)
 parser.add_argument("file_output", help="Filename for the output geopackage of stream segments", type=str)
-parser.add_argument("--basin_key", help='Integer value of the basin from which you want to extract the streams, as given by "*_MChiSegmented.csv" in LSDTT', type=int)
-parser.add_argument("--node_export", "-n", action="store_true", help="export all nodes (points) as well as the line network: may take a while")
+parser.add_argument("--basin_key", help='Integer value of the basin from which you want to extract the streams, as given by "*_MChiSegmented.csv" in LSDTT. A comma-separated list of basin keys, or "all-separate" for every basin, builds each basin as its own network from a single read of the file, and writes each one to its own layer ("basin_<key>") of the output geopackage(s)', type=str)
+parser.add_argument("--separate_files", action="store_true", help='With several basin keys, write each basin to its own geopackage(s), "<file_output>_basin<key>.gpkg", rather than to a layer')
+parser.add_argument("--node_export", "-n", action="store_true", help="export all nodes (points) as well as the line network, with their segment IDs and network node types")
+parser.add_argument("--node_batch_size", help="Number of nodes to write to the node geopackage at a time (default: 1000000)", type=int, default=1000000)
+parser.add_argument("--attribute", action="append", default=[], metavar="COLUMN[:REDUCTION]", help='additional "*_MChiSegmented.csv" column to summarize for each segment (e.g., "depth_to_bedrock:mean"); REDUCTION is one of mean (default), min, max, sum, range, first, last. May be repeated.')
+parser.add_argument("--jobs", "-j", help="Number of worker processes across which to divide the basins when building the network for all of them, or for a list of them (default: 1)", type=int, default=1)
+parser.add_argument("--cache", action="store_true", help="keep the network built from file_input in a binary cache (by default, in a " + lsdtt_network.CACHE_DIRNAME + " directory next to it), so that later runs on the same file, including for other basins, skip reading and tracing it")
+parser.add_argument("--cache_dir", help="Directory for the network cache; implies --cache", type=str)
+parser.add_argument("--cache_max_size", help="Size [MB] above which the least recently used cache entries are deleted (default: 10000)", type=float, default=10000.)
+parser.add_argument("--node_store", help="Keep the nodes read from file_input (all basins) in a memory-mapped store in this directory, a .npy array per column with each node's receiver, and reopen them from there, rather than reading file_input, for as long as file_input is unchanged. With --jobs, the worker processes open the store themselves, sharing one copy of it, and are sent only the rows of their basins", type=str)
+parser.add_argument("--reach_length", help='Also subdivide every segment into reaches of about this flow length [m], each with the segment attributes (and --attribute columns), its length, and the reach that it drains into ("toreach"), and write them to their own layer, "reaches" (or "basin_<key>_reaches")', type=float)
+parser.add_argument("--profile", nargs="?", const="", metavar="REPORT", help='Write a JSON report of the wall time, CPU time, peak memory and item counts of each stage of the run (reading, receivers, junctions, tracing, linkage, aggregation, topology, geometry, writing) to REPORT (default: "<file_output>_profile.json")')
+parser.add_argument("--profile_with", choices=["cProfile", "pyinstrument"], help='With --profile, also profile the run by function with cProfile (written beside the report as ".prof", for pstats or snakeviz) or pyinstrument (written as ".html")')
+parser.add_argument("--incremental", action="store_true", help="Rebuild only what has changed since the output geopackage(s) were last written, as told by a content hash of each basin's input rows (and of the options), recorded with the outputs. With several basin keys, only the layers (or files, with --separate_files) of basins that have changed are rebuilt and rewritten, and the rest are kept as they are. A single network, whose segment IDs run across all of its basins, is rebuilt whole if any basin has changed, and otherwise left as it is")
+parser.add_argument("--fail_on_branching", action="store_true", help="stop with an error if any segment drains into more than one downstream segment, rather than warning and keeping the first")
 
 # Parse file input and output names.
 # If the output file isn't specified as a geopackage, add the .gpkg file extension
@@ -29,11 +43,72 @@ file_output = args.file_output
 if file_output[-5:] != '.gpkg':
     file_output += '.gpkg'
 
-# Basin key selected?
-_basin_id = args.basin_key
+# Basin key(s) selected?
+# One integer gives a single network; a list, or "all-separate", gives
+# one network per basin
+_basin_id = None
+_batch_basins = None
+if args.basin_key is not None:
+    try:
+        if args.basin_key == 'all-separate':
+            _batch_basins = 'all'
+        elif ',' in args.basin_key:
+            _batch_basins = [int(_key) for _key in args.basin_key.split(',')
+                             if _key.strip()]
+        else:
+            _basin_id = int(args.basin_key)
+    except ValueError:
+        parser.error('--basin_key must be an integer, a comma-separated '
+                     + 'list of integers, or "all-separate"')
+_separate_files = args.separate_files
+
+# Any extra columns to add to the segments
+try:
+    _extra_attributes = [lsdtt_network.parse_attribute(_spec)
+                         for _spec in args.attribute]
+except ValueError as e:
+    parser.error(str(e))
+
+# Parallel build
+_jobs = args.jobs
+if _jobs > 1 and lsdtt_network.fork_context() is None:
+    print('Parallel building needs the "fork" start method; '
+          'building serially')
+
+# Network cache
+if args.cache_dir is not None:
+    _cache_dir = args.cache_dir
+elif args.cache:
+    _cache_dir = lsdtt_network.default_cache_dir(file_input)
+else:
+    _cache_dir = None
+_cache_max_size = args.cache_max_size * 1E6
+
+# Memory-mapped node store
+_node_store = args.node_store
+
+# Stop if the network branches?
+_fail_on_branching = args.fail_on_branching
+
+# Subdivide segments into reaches?
+_reach_length = args.reach_length
+if _reach_length is not None and _reach_length <= 0:
+    parser.error('--reach_length must be positive')
+
+# Profile the run?
+if args.profile is not None:
+    _profile_path = args.profile or (os.path.splitext(file_output)[0]
+                                     + '_profile.json')
+elif args.profile_with is not None:
+    parser.error('--profile_with requires --profile')
+else:
+    _profile_path = None
 
 # And give the nodes' output filename if needed
 _export_all_nodes = args.node_export
+_node_batch_size = args.node_batch_size
+if _node_batch_size < 1:
+    parser.error('--node_batch_size must be at least 1')
 if _export_all_nodes:
     file_output_nodes = os.path.splitext(file_output)[0] + '_nodes' + '.gpkg'
 
@@ -50,262 +125,378 @@ _write_ksn = True
 _export_all_nodes = True
 """    
 
-# Read the LSDTopoTools river chi profile inputs, indexing by the 
-# node index
-rp = pd.read_csv(file_input, index_col='node', na_filter=False)
-# The "source key" sets the ID for each segment -- section of channel between
-# tributary junctions.
-segment_ids = np.array(list(set(rp['source_key'])))
-
-# Get the source key for all receiver nodes
-# This will show the upstream limit(s) of confluences, and provide the
-# node IDs of these confluences.
-receiver_nodes_at_mouths = []
-rp.insert(len(rp.columns), 'receiver_source_key', None)
-#for _node in rp.index:
-# IMPORTANT FOR EFFICIENCY: MINIMIZE THE NUMBER OF TIMES YOU UPDATE THE
-# DATAFRAME
-
-# Limit to a single basin if so desired
-if _basin_id:
-    rp = rp[rp['basin_key'] == _basin_id]
-
-_tmplist = []
-for _node in rp.index:
-    _receiver_node = rp.loc[_node, 'receiver_node']
-    if _receiver_node in rp.index and _node != _receiver_node:
-        _receiver_source_key = rp.loc[_receiver_node, 'source_key']
-    else:
+def output_layers(file_output, file_output_nodes=None, layer=None):
+    """The (file, layer) pairs to which write_network writes a network."""
+    layers = [(file_output, layer)]
+    if _reach_length is not None:
+        layers.append((file_output,
+                       'reaches' if layer is None else layer + '_reaches'))
+    if file_output_nodes is not None:
+        layers.append((file_output_nodes, layer))
+    return layers
+
+
+def basin_metadata(keys):
+    """
+    Metadata recording the contents of the input rows of the given basins,
+    and the options, from which outputs are written (for --incremental).
+    """
+    return {'basin_blake2b': json.dumps({str(_key): _basin_digests[_key]
+                                         for _key in keys}, sort_keys=True),
+            'options_blake2b': _options_digest}
+
+
+def is_current(keys, file_output, file_output_nodes=None, layer=None):
+    """
+    Whether the outputs of the given basins in a layer were written from
+    the same input rows, and with the same options, as they would be now.
+    """
+    _metadata = basin_metadata(keys)
+    for _path, _layer in output_layers(file_output, file_output_nodes,
+                                       layer):
+        _stored = lsdtt_network.read_gpkg_metadata(_path, _layer)
+        if any(_stored.get(_k) != _v for _k, _v in _metadata.items()):
+            return False
+    return True
+
+
+def write_network(network, file_output, file_output_nodes=None, layer=None,
+                  metadata=None):
+    """
+    Report on a network and write its segments (and, if file_output_nodes
+    is given, its nodes) to GeoPackage, in the given layer, with metadata
+    alongside that of the source file.
+    """
+    rp = network['nodes']
+    toseg = network['toseg']
+
+    for _receiver_node in rp['receiver_node'].values[network['at_mouth']]:
         print("Found mouth node. Offmap receiver node ID: "
                 + str(_receiver_node))
-        _receiver_source_key = -1
-        receiver_nodes_at_mouths.append(_receiver_node)
-    _tmplist.append(_receiver_source_key)
-rp['receiver_source_key'] = _tmplist
-
-# In the case of the downstream-most one, no node with this ID will exist
-mouth_nodes = list(rp[rp['receiver_source_key'] == -1].index)
-
-# Next, identify these confluences by places where the receiver_source_key
-# differs from the source_key
-confluence_downstream_nodes = list(set(list(rp['receiver_node']
-                                                  [rp['source_key'] !=
-                                                  rp['receiver_source_key']])))
-# Remove river mouths
-# Inefficient but should be relatively few points at this step.
-confluence_downstream_nodes = np.array(confluence_downstream_nodes)
-for _receiver_node_at_mouth in receiver_nodes_at_mouths:
-    confluence_downstream_nodes = confluence_downstream_nodes\
-                                    [confluence_downstream_nodes
-                                     != _receiver_node_at_mouth]
-
-# Create a set of confluence locations
-confluences = []
-for _node in confluence_downstream_nodes:
-    _x = rp.loc[_node, 'longitude']
-    _y = rp.loc[_node, 'latitude']
-    confluences.append([_x, _y])
-confluences = np.array(confluences)
-
-# Create a set of river mouth locations
-mouths = []
-for _node in mouth_nodes:
-    _x = rp.loc[_node, 'longitude']
-    _y = rp.loc[_node, 'latitude']
-    mouths.append([_x, _y])
-mouths = np.array(mouths)
-
-# Obtain channel-head locations
-# They are in another file, but whatever.... reduce data dependencies
-channel_head_nodes = []
-source_keys = list(set(list(rp['source_key'])))
-for _source_key in source_keys:
-    channel_head_nodes.append( rp.index[rp['source_key'] == _source_key][0] )
-channel_head_nodes = np.array(channel_head_nodes)
-
-# Create a list of segment sources
-# This includes all channel heads (true "sources") and confluences
-source_nodes = np.hstack(( channel_head_nodes, confluence_downstream_nodes ))
-
-# Create a list of segment terminations
-# This includes all confluence and mouth nodes
-termination_nodes = np.hstack(( confluence_downstream_nodes, mouth_nodes ))
-
-# Create a list of lists of node IDs going down each segment in the network
-# Each segment will include as its downstream-most cell the upstream-most
-# node from the next tributary junction.
-# This is duplicitive, but helpful for network dynamics and plotting
-# line segments that represent the river attributes.
-segments_nodes = []
-for _source_node in source_nodes:
-    segment_nodes = [_source_node]
-    segment_nodes.append(rp.loc[segment_nodes[-1], 'receiver_node'])
-    while segment_nodes[-1] not in termination_nodes:
-        segment_nodes.append(rp.loc[segment_nodes[-1], 'receiver_node'])
-    segments_nodes.append(segment_nodes)
-
-# Next, reconstruct the data table elements for each of these points
-# within its specific segment in the network
-segments = []
-for segment_nodes in segments_nodes:
-    segments.append( rp.loc[segment_nodes, :] )
-
-# Apply an arbitrary ID in order
-_id = 0
-segment_ids = []
-for segment in segments:
-    segment_ids.append(_id)
-    segment['segment_id'] = _id
-    _id += 1
-segment_ids = np.array(segment_ids)
 
-# Obtain correlative ID numbers from the source nodes
-internal_segment_ids = []
-for segment in segments:
-    internal_segment_ids.append(segment.index[0])
-internal_segment_ids = np.array(internal_segment_ids)
+    toseg_report = network['report']
+    print(str(len(toseg)) + " segments; "
+            + str(len(toseg_report['mouths']))
+            + " channel mouth(s) (toseg -1)")
+    for _segment_id, _candidates in toseg_report['branching'].items():
+        print("WARNING! NETWORK IS BRANCHING. Segment " + str(_segment_id)
+                + " drains into segments " + str(_candidates)
+                + "; using " + str(toseg[_segment_id]))
+
+    # Until all of the outputs have been rewritten, they match no input
+    for _path, _layer in output_layers(file_output, file_output_nodes,
+                                       layer):
+        if lsdtt_network.read_gpkg_metadata(_path, _layer) \
+                .get('basin_blake2b'):
+            lsdtt_network.write_gpkg_metadata(_path, _layer,
+                                              {'basin_blake2b': ''})
+
+    lsdtt_network.write_network(
+        network, file_output, file_output_nodes, layer=layer,
+        metadata=dict(_source_metadata, **(metadata or {})), reach_length=_reach_length,
+        reach_attributes=[lsdtt_network.REACH_ATTRIBUTES[0]]
+                         + _segment_attributes,
+        node_batch_size=_node_batch_size)
+
+    _written.append(lsdtt_network.network_metadata(network))
+
+    print("Segments written to", file_output)
+    if _reach_length is not None:
+        print("Reaches written to", file_output)
+    if file_output_nodes is not None:
+        print('Nodes written to', file_output_nodes)
+
+
+# Start profiling: by stage, and by function if requested
+if _profile_path is not None:
+    lsdtt_network.start_profile()
+    if args.profile_with == 'cProfile':
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    elif args.profile_with == 'pyinstrument':
+        try:
+            import pyinstrument
+        except ImportError:
+            parser.error('--profile_with pyinstrument requires pyinstrument')
+        _profiler = pyinstrument.Profiler()
+        _profiler.start()
+# Counts of what is written, for the profile
+_written = []
+
+# Where the outputs come from, for their metadata, and to tell whether the
+# node store is up to date: the input file, its size and modification time,
+# and its content hash. The hash is taken as the file is read, or beforehand
+# to key the network cache (which remembers it against the file's size and
+# modification time), or else it is carried over from a node store written
+# from the file as it is now.
+_input_stat = os.stat(file_input)
+_source_metadata = {'source_file': os.path.abspath(file_input),
+                    'source_size': _input_stat.st_size,
+                    'source_mtime_ns': _input_stat.st_mtime_ns}
+
+def is_current_source(source):
+    """Whether a recorded source is file_input as it is now."""
+    if not source or source.get('source_file') \
+            != _source_metadata['source_file']:
+        return False
+    # A source recorded without its hash is out of date, so that what is
+    # written from it gets the hash
+    if 'source_blake2b' not in source:
+        return False
+    if 'source_blake2b' in _source_metadata:
+        return source['source_blake2b'] == _source_metadata['source_blake2b']
+    return all(source.get(_k) == _source_metadata[_k]
+               for _k in ('source_size', 'source_mtime_ns'))
+
+if _cache_dir is not None:
+    with lsdtt_network.profile_stage('digest'):
+        _source_metadata['source_blake2b'] = lsdtt_network.file_digest(
+                                                file_input, _cache_dir)
+elif _node_store is not None:
+    _store = lsdtt_network.open_node_store(_node_store, columns=[])
+    if _store is not None and is_current_source(_store['source']):
+        _source_metadata['source_blake2b'] = \
+            _store['source']['source_blake2b']
 
-# Also record which segment they send their flow to
-internal_receiver_segment_ids = []
-for segment in segments:
-    internal_receiver_segment_ids.append( segment.index[-1] )
-internal_receiver_segment_ids = np.array(internal_receiver_segment_ids)
-
-# To-segment IDs
-toseg = []
-for i in range(len(internal_segment_ids)):
-    toseg_bool = (internal_receiver_segment_ids[i] == internal_segment_ids)
-    if np.sum(toseg_bool) > 1:
-        print(i)
-        print(np.sum(toseg_bool))
-        print("ERROR! NETWORK IS BRANCHING.")
-    elif np.sum(toseg_bool) == 0:
-        print(i)
-        print(np.sum(toseg_bool))
-        print("Channel mouth; segment ID -1.")
-        toseg.append(-1)
+# Read the LSDTopoTools river chi profile inputs, indexing by the 
+# node index. Only the columns that we need are read (all of them if the
+# nodes are to be exported), and the rows are limited to the selected
+# basin(s) as they are read if so desired.
+# Default attributes whose columns are not in this kind of file (e.g.,
+# ksn from m_chi in a chi_data_map) are left out.
+try:
+    _available_columns, _schema = lsdtt_network.node_table_columns(
+                                    file_input)
+except ValueError as e:
+    parser.error(str(e))
+_default_attributes = lsdtt_network.available_attributes(
+                        lsdtt_network.SEGMENT_ATTRIBUTES, _available_columns)
+for _a in lsdtt_network.SEGMENT_ATTRIBUTES:
+    if _a not in _default_attributes:
+        print('No "' + '", "'.join(np.atleast_1d(_a[1])) + '" in '
+              + _schema + ' input; skipping segment attribute "'
+              + _a[0] + '"')
+if _export_all_nodes:
+    _columns = None
+else:
+    _columns = lsdtt_network.network_columns(
+                _default_attributes + _extra_attributes, _available_columns)
+_segment_attributes = _default_attributes + _extra_attributes
+_build_options = {'attributes': _segment_attributes,
+                  'fail_on_branching': _fail_on_branching}
+
+# Besides the input rows of each basin (over the columns read), what the
+# outputs depend on: recorded with them, for --incremental
+_digest_columns = _columns if _columns is not None else _available_columns
+_options_digest = hashlib.blake2b(json.dumps(
+                    {'columns': _digest_columns,
+                     'attributes': _segment_attributes,
+                     'fail_on_branching': _fail_on_branching,
+                     'reach_length': _reach_length,
+                     'node_export': _export_all_nodes},
+                    sort_keys=True).encode(), digest_size=20).hexdigest()
+
+if _cache_dir is not None:
+    _cache_options = {'columns': _columns,
+                      'attributes': [_a[:3] for _a in _extra_attributes],
+                      'fail_on_branching': _fail_on_branching}
+    _whole_file_cache_path = lsdtt_network.network_cache_path(
+                                _cache_dir, file_input, basin_key=None,
+                                **_cache_options)
+
+# The row of each node's receiver, when the node table is the whole of a
+# node store
+_receiver_rows = None
+
+def _read_file(**kwargs):
+    """Read file_input, taking its content hash as it is read."""
+    try:
+        rp, _source_metadata['source_blake2b'] = \
+            lsdtt_network.read_node_table(file_input, columns=_columns,
+                                          return_digest=True, **kwargs)
+    except ValueError as e:
+        parser.error(str(e))
+    return rp
+
+def _read_node_table(basin_key):
+    global _receiver_rows
+    if _node_store is not None:
+        # The store holds every basin, and is remade if file_input (or the
+        # set of columns needed) has changed since it was written
+        store = lsdtt_network.open_node_store(_node_store, _digest_columns)
+        if store is not None and is_current_source(store['source']):
+            print("Nodes read from node store")
+        else:
+            rp = _read_file()
+            try:
+                lsdtt_network.save_node_store(rp, _node_store,
+                                              source=_source_metadata)
+            except ValueError as e:
+                parser.error(str(e))
+            print("Node store written to", _node_store)
+            store = lsdtt_network.open_node_store(_node_store,
+                                                  _digest_columns)
+        rp = store['nodes']
+        if basin_key is None:
+            _receiver_rows = store['receiver_rows']
+            return rp
+        return rp[rp['basin_key'].isin(np.atleast_1d(basin_key))]
+    return _read_file(basin_key=basin_key)
+
+def basin_outputs(key):
+    """The output file(s) and layer for one basin of several."""
+    if _separate_files:
+        _base = os.path.splitext(file_output)[0] + '_basin' + str(key)
+        return (_base + '.gpkg',
+                _base + '_nodes.gpkg' if _export_all_nodes else None, None)
+    return (file_output, file_output_nodes if _export_all_nodes else None,
+            'basin_' + str(key))
+
+if _batch_basins is None:
+    # A single network: for one basin, or for the whole file.
+    # Look for a network already built from this file with these options:
+    # first for this basin, and then for the whole file, from which the
+    # basin can be cut out
+    network = None
+    if _cache_dir is not None:
+        _cache_path = lsdtt_network.network_cache_path(
+                        _cache_dir, file_input, basin_key=_basin_id,
+                        **_cache_options)
+        network = lsdtt_network.load_network(_cache_path)
+        if network is None and _basin_id is not None:
+            network = lsdtt_network.load_network(_whole_file_cache_path)
+            if network is not None:
+                network = lsdtt_network.select_basin(network, _basin_id)
+        if network is not None:
+            print("Network read from cache")
+    rp = _read_node_table(_basin_id) if network is None else network['nodes']
+    if _basin_id is not None and len(rp) == 0:
+        print("No nodes found for basin_key " + str(_basin_id)
+              + "; nothing written")
+        sys.exit(1)
+    with lsdtt_network.profile_stage('basin digests'):
+        _basin_digests = lsdtt_network.basin_digests(rp, _digest_columns)
+    _nodes_output = file_output_nodes if _export_all_nodes else None
+
+    if args.incremental and is_current(_basin_digests, file_output,
+                                       _nodes_output):
+        print("No basin has changed since " + file_output
+              + " was written; leaving it as it is")
+        for _path, _layer in output_layers(file_output, _nodes_output):
+            lsdtt_network.write_gpkg_metadata(_path, _layer,
+                                              _source_metadata)
     else:
-        toseg.append(int(segment_ids[toseg_bool]))
-toseg = np.array(toseg)
-
-# Unnecessary, but why not? Makes life easier.
-# Especially once I use these to create the nodes!
-for i in range(len(segments)):
-    segment = segments[i]
-    segment['toseg'] = internal_receiver_segment_ids[i] # = toseg
-    _id += 1
-
-# Now we have the full set of points that can be written to file.
-# But how about the GIS lines?
-# Let's get more information in each segment.
-# And let's add it to its own DataFrame
-
-
-dfsegs = pd.DataFrame({'id': segment_ids, 'toseg': toseg})
-
-
-############################
-# Add mean lat/lon columns #
-############################
-
-_out = []
-for segment in segments:
-    _out.append( segment['longitude'].mean() )
-dfsegs['longitude (mean)'] = _out
-
-_out = []
-for segment in segments:
-    _out.append( segment['latitude'].mean() )
-dfsegs['latitude (mean)'] = _out
-
-
-###############
-# Add columns #
-###############
-
-# Segment slope
-_out = []
-for segment in segments:
-    _out.append( (np.max(segment['elevation']) - np.min(segment['elevation'])) /
-                 (np.max(segment['flow_distance']) - np.min(segment['flow_distance'])) )
-dfsegs['slope'] = _out
-
-# Segment elevations:
-_max = []
-_min = []
-_mean = []
-for segment in segments:
-    _mean.append(np.mean(segment['elevation']))
-    _max.append(np.max(segment['elevation']))
-    _min.append(np.min(segment['elevation']))
-dfsegs['z mean'] = _mean
-dfsegs['z_max'] = _max
-dfsegs['z_min'] = _min
-    
-# Segment drainage area (mean across segment)
-_out = []
-for segment in segments:
-    _out.append(np.mean(segment['drainage_area'])/1E6)
-dfsegs['drainage area (mean) [km2]'] = _out
-
-# Segment chi (mean across segment)
-_out = []
-for segment in segments:
-    _out.append(np.mean(segment['chi']))
-dfsegs['chi'] = _out
-
-# Segment normalized steepness index, *assuming this = m_chi from LSDTT*
-# (This is true for the default A_0 = 1)
-_out = []
-for segment in segments:
-    _out.append(np.mean(segment['m_chi']))
-dfsegs['ksn'] = _out
-
-################################################################
-# Find a way in the future to add custom values to the columns #
-################################################################
-
-# These are going to be particular to this case
-#dfsegs['depth_to_bedrock_m'][i] = np.mean(segment['depth_to_bedrock'])
-#dfsegs['bedrock_lithology'] = np.mean(segment['depth_to_bedrock'])
-
-
-# Create a set of LineString objects
-stream_lines = []
-for segment in segments:
-    stream_lines.append( LineString(
-                            segment.loc[:, ('longitude', 'latitude', 'elevation')].values ) )
-
-# Now convert to geopandas
-gdf_segs = gpd.GeoDataFrame( dfsegs, geometry=stream_lines, crs="EPSG:4326")
-
-# Save to GeoPackage
-gdf_segs.to_file(file_output, driver="GPKG")
-
-print("Segments written to", file_output)
-
-
-"""
-#############################################################################
-# If we subdivide the network further, we could make it better for plotting #
-#############################################################################
-
-subseg_target_length = 200.
-
-seg_length = segment['flow_distance'].max() - segment['flow_distance'].min()
-n_subseg = int(np.round(seg_length/subseg_target_length))
-l_subseg_target2 = seg_length / n_subseg
-
-# The last one might be a bit longer, but it's just for plotting.
-subsegs = []
-for i in range(n_subseg-1):
-    _dist = segment['flow_distance'] - segment['flow_distance'].min()
-    subsegs.append( segment[ (_dist >= (subseg_target_length*i))
-                             & (_dist < (subseg_target_length*(i+1))) ] )
-subsegs.append( segment[ _dist >= subseg_target_length*(i+1)] )
-
-    segment['flow_distance'].max()
-"""
+        if network is None:
+            if _jobs > 1 and _basin_id is None:
+                # Basins are independent drainage trees, so build them side
+                # by side
+                network = lsdtt_network.build_network_by_basin(
+                            rp, jobs=_jobs, node_store=_node_store,
+                            **_build_options)
+            else:
+                network = lsdtt_network.build_network(
+                            rp, receiver_rows=_receiver_rows,
+                            **_build_options)
+            if _cache_dir is not None:
+                lsdtt_network.save_network(network, _cache_path)
+                lsdtt_network.evict_cache(_cache_dir, _cache_max_size,
+                                          keep=[_cache_path])
+
+        write_network(network, file_output, _nodes_output,
+                      metadata=basin_metadata(_basin_digests))
+
+else:
+    # Batch mode: one network per basin, from a single read of the file.
+    # Networks come from the whole-file cache entry if there is one.
+    network = None
+    if _cache_dir is not None:
+        network = lsdtt_network.load_network(_whole_file_cache_path)
+        if network is not None:
+            print("Network read from cache")
+    if network is None:
+        rp = _read_node_table(None if _batch_basins == 'all'
+                              else _batch_basins)
+    else:
+        rp = network['nodes']
+    with lsdtt_network.profile_stage('basin digests'):
+        _basin_digests = lsdtt_network.basin_digests(rp, _digest_columns)
+
+    # Basins whose outputs are up to date are left out of the build
+    unchanged = []
+    if args.incremental:
+        unchanged = [_key for _key in _basin_digests
+                     if (_batch_basins == 'all' or _key in _batch_basins)
+                     and is_current([_key], *basin_outputs(_key))]
+
+    if network is not None:
+        if _batch_basins == 'all':
+            _batch_basins = list(np.unique(
+                                network['nodes']['basin_key'].values))
+        networks = {_key: lsdtt_network.select_basin(network, _key)
+                    for _key in _batch_basins if _key not in unchanged}
+    else:
+        if unchanged:
+            rp = rp[~rp['basin_key'].isin(unchanged)]
+        networks = lsdtt_network.build_networks_by_basin(
+                    rp, jobs=_jobs, node_store=_node_store,
+                    **_build_options)
+        # Having built every basin, we can also keep the whole network
+        if _cache_dir is not None and _batch_basins == 'all' \
+                and not unchanged:
+            lsdtt_network.save_network(
+                lsdtt_network.merge_networks(list(networks.values())),
+                _whole_file_cache_path)
+            lsdtt_network.evict_cache(_cache_dir, _cache_max_size,
+                                      keep=[_whole_file_cache_path])
+    missing = [_key for _key in networks if len(networks[_key]['nodes']) == 0]
+    if _batch_basins != 'all':
+        missing = [_key for _key in _batch_basins if _key not in unchanged
+                   and (_key not in networks
+                        or len(networks[_key]['nodes']) == 0)]
+    for _key in missing:
+        print("WARNING: no nodes found for basin_key " + str(_key))
+
+    # Unchanged basins keep their outputs, with the source file updated in
+    # their metadata
+    for _key in unchanged:
+        print("Basin " + str(_key) + ": unchanged; keeping its output")
+        for _path, _layer in output_layers(*basin_outputs(_key)):
+            lsdtt_network.write_gpkg_metadata(_path, _layer,
+                                              _source_metadata)
+
+    # One layer per basin in the output file(s), or one file per basin
+    for _key, network in networks.items():
+        if _key in missing:
+            continue
+        print("Basin " + str(_key) + ":")
+        write_network(network, *basin_outputs(_key),
+                      metadata=basin_metadata([_key]))
+
+# Finish profiling, and write the report
+if _profile_path is not None:
+    _profile_base = os.path.splitext(_profile_path)[0]
+    if args.profile_with == 'cProfile':
+        _profiler.disable()
+        _profiler.dump_stats(_profile_base + '.prof')
+    elif args.profile_with == 'pyinstrument':
+        _profiler.stop()
+        with open(_profile_base + '.html', 'w') as f:
+            f.write(_profiler.output_html())
+    _versions = {'python': sys.version.split()[0]}
+    for _module in ('numpy', 'pandas', 'pyarrow', 'shapely', 'geopandas',
+                    'pyogrio'):
+        if _module in sys.modules:
+            _versions[_module] = getattr(sys.modules[_module],
+                                         '__version__', None)
+    _counts = {_key: int(sum(_w[_key] for _w in _written))
+               for _key in ('nodes', 'segments', 'segment_nodes',
+                            'channel_heads', 'confluences', 'mouths')}
+    lsdtt_network.stop_profile().write(
+        _profile_path, argv=sys.argv, input=os.path.abspath(file_input),
+        input_bytes=os.path.getsize(file_input), jobs=_jobs,
+        counts=_counts, versions=_versions)
+    print("Profile written to", _profile_path)
 
 
 """
@@ -330,16 +521,3 @@ gdf_segsselect.to_file('segs_select.gpkg', driver="GPKG")
 print('Your geopackage is ready!')
 print('Open in GIS to select your starter segment_ID.')
 """
-
-
-if _export_all_nodes:
-    print("Exporting all nodes; this may take some time...")
-    # Export nodes for use of plotting
-    dfnodes = pd.concat(segments)
-    dfnodes['network_node_type'] = ""
-    #for mouth in mouth_nodes:
-    #   dfnodes.loc[mouth]['network_node_type'] = 'mouth'
-    gdf_NetworkNodes = gpd.GeoDataFrame( dfnodes, geometry=gpd.points_from_xy(dfnodes.longitude, dfnodes.latitude, dfnodes.elevation), crs="EPSG:4326")
-    gdf_NetworkNodes.to_file(file_output_nodes, driver="GPKG")
-    print('Nodes written to', file_output_nodes)
-
@@ -0,0 +1,2134 @@
+"""
+Network-building routines shared by the LSDTT network tools.
+
+The node table is addressed by row position throughout: receivers are given
+as integer row indices (-1 for receivers that are not in the table), and
+segments are stored CSR-style, as an array of node rows plus an array of
+offsets such that segment i is node_rows[offsets[i]:offsets[i+1]].
+
+Networks are plain dicts of these arrays and tables, as built by
+build_network; the Network class wraps one with methods for use from other
+Python code. Only numpy is imported up front: pandas, geopandas, shapely,
+pyarrow and pyogrio are imported by the functions that need them, so that
+importing this module (and starting the command-line tools) stays quick.
+"""
+
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+
+#############
+# Profiling #
+#############
+
+class RunProfile:
+    """
+    Wall time, CPU time (including that of finished worker processes), peak
+    resident memory and item counts for each stage of a run, as recorded by
+    profile_stage while the profile is active (see start_profile).
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._start = _profile_clock()
+
+    def report(self, **extra):
+        """The profile as a JSON-ready dict, with any extra entries."""
+        end = _profile_clock()
+        totals = {}
+        for stage in self.stages:
+            total = totals.setdefault(stage['stage'],
+                                      {'calls': 0, 'wall_s': 0.,
+                                       'cpu_s': 0.})
+            total['calls'] += 1
+            total['wall_s'] += stage['wall_s']
+            total['cpu_s'] += stage['cpu_s']
+        return dict(extra,
+                    total={'wall_s': end[0] - self._start[0],
+                           'cpu_s': end[1] - self._start[1],
+                           'peak_rss_mb': end[2]},
+                    stages=self.stages,
+                    stage_totals=totals)
+
+    def write(self, path, **extra):
+        """Write the report (see report) to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.report(**extra), f, indent=2, default=_json_value)
+
+
+_active_profile = None
+
+
+def start_profile():
+    """Start recording stages into a new RunProfile, and return it."""
+    global _active_profile
+    _active_profile = RunProfile()
+    return _active_profile
+
+
+def stop_profile():
+    """Stop recording stages, returning the profile that was active."""
+    global _active_profile
+    profile, _active_profile = _active_profile, None
+    return profile
+
+
+@contextlib.contextmanager
+def profile_stage(name, **counts):
+    """
+    Time the enclosed block as a stage of the active profile, if any. The
+    dict that is yielded holds the stage's item counts (starting with
+    counts), to which the block can add.
+    """
+    record = dict(counts)
+    if _active_profile is None:
+        yield record
+        return
+    profile = _active_profile
+    start = _profile_clock()
+    try:
+        yield record
+    finally:
+        end = _profile_clock()
+        profile.stages.append({'stage': name,
+                               'wall_s': end[0] - start[0],
+                               'cpu_s': end[1] - start[1],
+                               'peak_rss_mb': end[2],
+                               'counts': record})
+
+
+def _profile_clock():
+    # Wall time, CPU time of this process and its children, and peak RSS
+    # [MB] of either (None where the resource module is unavailable)
+    times = os.times()
+    try:
+        import resource
+    except ImportError:
+        peak_rss = None
+    else:
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # Reported in bytes on macOS, and in kilobytes elsewhere
+        peak_rss /= 1E6 if sys.platform == 'darwin' else 1E3
+    return (time.perf_counter(), times[0] + times[1] + times[2] + times[3],
+            peak_rss)
+
+
+def _json_value(value):
+    # numpy scalars and arrays in profile counts
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(type(value).__name__ + " is not JSON serializable")
+
+
+#########
+# Input #
+#########
+
+# Explicit types for the LSDTopoTools "*_MChiSegmented.csv" columns.
+# Node IDs are raster cell indices, which can exceed the int32 range on
+# large DEMs. Coordinates stay in double precision so that node positions
+# are not rounded by up to a metre, as do elevation and flow distance,
+# whose small differences along a segment give its slope.
+NODE_COLUMN_DTYPES = {
+    'node': np.int64,
+    'receiver_node': np.int64,
+    'source_key': np.int32,
+    'basin_key': np.int32,
+    'latitude': np.float64,
+    'longitude': np.float64,
+    'elevation': np.float64,
+    'flow_distance': np.float64,
+    'chi': np.float32,
+    'drainage_area': np.float32,
+    'm_chi': np.float32,
+    'b_chi': np.float32,
+    'segmented_elevation': np.float32,
+    }
+
+# Columns that are needed to build the network and its default attributes
+NETWORK_COLUMNS = ['node', 'receiver_node', 'source_key', 'basin_key',
+                   'latitude', 'longitude', 'elevation', 'flow_distance',
+                   'drainage_area', 'chi', 'm_chi']
+
+
+# Input file layouts, as the renaming of their columns to those of the
+# node table (the "*_MChiSegmented.csv" names). Files are recognized by
+# having all of the renamed columns. Another LSDTopoTools output can be
+# read by adding its layout here.
+INPUT_SCHEMAS = {
+    'MChiSegmented': {'node': 'node', 'receiver_node': 'receiver_node'},
+    'chi_data_map': {'NI': 'node', 'receiver_NI': 'receiver_node'},
+    }
+
+
+def detect_schema(header):
+    """
+    Name of the first of INPUT_SCHEMAS whose columns are all in header
+    (the column names of an input file).
+    """
+    for name, renaming in INPUT_SCHEMAS.items():
+        if all(c in header for c in renaming):
+            return name
+    raise ValueError("Unrecognized input: expected the columns of one of "
+                     + "; ".join(name + " (" + ", ".join(renaming) + ")"
+                                 for name, renaming in INPUT_SCHEMAS.items()))
+
+
+def node_table_columns(path):
+    """
+    The columns of an input file, as they are named in the node table,
+    and the name of its layout in INPUT_SCHEMAS.
+    """
+    import pandas as pd
+
+    header = list(pd.read_csv(path, nrows=0).columns)
+    schema = detect_schema(header)
+    renaming = INPUT_SCHEMAS[schema]
+    return [renaming.get(c, c) for c in header], schema
+
+
+class _HashingFile(io.RawIOBase):
+    """
+    A binary file, opened for reading, that hashes (BLAKE2b, as
+    file_digest) everything read from it, so that a file can be hashed as
+    it is parsed rather than read twice.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._hash = hashlib.blake2b(digest_size=20)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = self._file.readinto(buffer)
+        self._hash.update(memoryview(buffer)[:n])
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+    def hexdigest(self):
+        """The digest of the whole file, reading whatever is left of it."""
+        for _block in iter(lambda: self._file.read(1 << 24), b''):
+            self._hash.update(_block)
+        return self._hash.hexdigest()
+
+
+def read_node_table(path, columns=None, basin_key=None,
+                    chunksize=1000000, return_digest=False):
+    """
+    Read an LSDTopoTools "*_MChiSegmented.csv" or "*_chi_data_map.csv" file
+    (or another of INPUT_SCHEMAS, detected from its columns) into a node
+    table indexed by node ID, with the columns named as in the first.
+
+    Only the requested columns are parsed (all of them if columns is None),
+    using the types in NODE_COLUMN_DTYPES. Other columns are typed from
+    the whole of the file, as pandas would type them: integer, or else
+    floating point, or else text. The file is streamed in blocks,
+    and if basin_key is given (as one key or a list of them), each block is
+    filtered to the selected basin(s) as it is read, so that the rest of the
+    file never has to be held in memory.
+    Streaming uses pyarrow's CSV reader if pyarrow is installed, and pandas
+    read_csv in chunks of chunksize rows otherwise.
+
+    With return_digest, the content hash of the file (as file_digest gives
+    it) is taken as the file is read, and returned as well, as
+    (node_table, digest).
+    """
+    import pandas as pd
+
+    with profile_stage('read') as counts:
+        header, schema = node_table_columns(path)
+        if columns is None:
+            columns = list(header)
+        else:
+            columns = list(dict.fromkeys(['node'] + list(columns)))
+        # Filtering by basin needs the basin keys, even if they are not kept
+        read_columns = list(columns)
+        if basin_key is not None and 'basin_key' not in read_columns:
+            read_columns.append('basin_key')
+        missing = [c for c in read_columns if c not in header]
+        if missing:
+            raise ValueError("Column(s) not found in " + path + ": "
+                             + ", ".join(missing))
+        # Everything from here on is in terms of the file's own column names
+        renaming = INPUT_SCHEMAS[schema]
+        file_names = {v: k for k, v in renaming.items()}
+        columns = [file_names.get(c, c) for c in columns]
+        dtypes = {file_names.get(c, c): NODE_COLUMN_DTYPES[c]
+                  for c in read_columns if c in NODE_COLUMN_DTYPES}
+        read_columns = [file_names.get(c, c) for c in read_columns]
+        if basin_key is not None:
+            basin_keys = np.atleast_1d(basin_key).astype(np.int32)
+            basin_key_column = file_names.get('basin_key', 'basin_key')
+
+        source = _HashingFile(path) if return_digest else path
+        reader = None
+        try:
+            try:
+                import pyarrow as pa
+                import pyarrow.compute as pc
+                import pyarrow.csv
+            except ImportError:
+                # read_csv would type other columns chunk by chunk, so they
+                # are read as text and converted once all is read
+                untyped = [c for c in read_columns if c not in dtypes]
+                column_types = dict(dtypes, **{c: str for c in untyped})
+                chunks = []
+                for chunk in pd.read_csv(source, usecols=read_columns,
+                                         dtype=column_types,
+                                         chunksize=chunksize):
+                    if basin_key is not None:
+                        chunk = chunk[chunk[basin_key_column].isin(basin_keys)]
+                    chunks.append(chunk)
+                node_table = pd.concat(chunks, ignore_index=True)
+                for c in untyped:
+                    for _type in (np.int64, np.float64):
+                        try:
+                            node_table[c] = node_table[c].astype(_type)
+                        except (ValueError, TypeError):
+                            continue
+                        break
+            else:
+                if basin_key is not None:
+                    basin_key_set = pa.array(basin_keys)
+                # pyarrow would type other columns from the first block alone,
+                # so they are read as text and converted once all is read
+                untyped = [c for c in read_columns if c not in dtypes]
+                column_types = {c: pa.from_numpy_dtype(t)
+                                for c, t in dtypes.items()}
+                column_types.update({c: pa.string() for c in untyped})
+                reader = pyarrow.csv.open_csv(
+                            source,
+                            convert_options=pyarrow.csv.ConvertOptions(
+                                include_columns=read_columns,
+                                column_types=column_types,
+                                strings_can_be_null=True))
+                batches = []
+                for batch in reader:
+                    if basin_key is not None:
+                        batch = batch.filter(pc.is_in(batch[basin_key_column],
+                                                      value_set=basin_key_set))
+                    batches.append(batch)
+                table = pa.Table.from_batches(batches, schema=reader.schema)
+                for c in untyped:
+                    for _type in (pa.int64(), pa.float64()):
+                        try:
+                            _column = pc.cast(table[c], _type)
+                        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                            continue
+                        table = table.set_column(
+                                table.schema.get_field_index(c), c, _column)
+                        break
+                node_table = table.to_pandas()
+            if return_digest:
+                digest = source.hexdigest()
+        finally:
+            # pyarrow reads ahead from a thread of its own, which must not
+            # be left reading from a Python file (as source is when it is
+            # hashed): a reader given up on is run to the end of the file
+            if return_digest and reader is not None:
+                try:
+                    for _batch in reader:
+                        pass
+                except Exception:
+                    pass
+            reader = None
+            if return_digest:
+                source.close()
+        node_table = node_table[columns].rename(columns=renaming) \
+                                       .set_index('node')
+        counts['nodes'] = len(node_table)
+    if return_digest:
+        return node_table, digest
+    return node_table
+
+
+def trace_segments(receiver_rows, is_termination, source_rows):
+    """
+    Walk down the network from each source row until reaching a termination.
+
+    Each segment includes its source and, as its downstream-most node, the
+    termination that it reaches: this is the upstream-most node of the next
+    segment downstream (or the mouth). The first step is always taken, so
+    a source that is itself a termination (i.e., a confluence) still starts
+    a segment. Every node is visited once per segment that contains it, so
+    the cost is linear in the size of the network.
+
+    Returns (offsets, node_rows).
+    """
+    receiver = np.asarray(receiver_rows).tolist()
+    terminates = np.asarray(is_termination, dtype=bool).tolist()
+    node_rows = []
+    offsets = [0]
+    for _row in np.asarray(source_rows).tolist():
+        node_rows.append(_row)
+        _row = receiver[_row]
+        while _row >= 0:
+            node_rows.append(_row)
+            if terminates[_row]:
+                break
+            _row = receiver[_row]
+        else:
+            raise ValueError("Segment starting at row "
+                             + str(node_rows[offsets[-1]])
+                             + " runs off the map without reaching a"
+                             + " confluence or mouth")
+        offsets.append(len(node_rows))
+    return np.array(offsets, dtype=np.int64), np.array(node_rows, dtype=np.int64)
+
+
+def resolve_toseg(first_nodes, last_nodes, fail_on_branching=False):
+    """
+    Link each segment to the segment downstream of it: the one whose first
+    node is this segment's last node. Matching uses a sorted lookup on the
+    first nodes, so it costs O(S log S) rather than a comparison of every
+    segment against every other.
+
+    Returns (toseg, report). Segments with no downstream match drain out of
+    the network and get toseg = -1, as do one-node channels (a segment
+    that starts and ends at the same node, e.g., a basin of one node),
+    which would otherwise match themselves. If more than one segment starts at the
+    node where a segment ends, the network is branching; the lowest
+    matching segment ID is used, unless fail_on_branching is set, in which
+    case a ValueError is raised. report is a dict holding the segment IDs
+    of the mouths ('mouths') and a mapping from each branching segment to
+    all of its candidate downstream segments ('branching').
+    """
+    first_nodes = np.asarray(first_nodes)
+    last_nodes = np.asarray(last_nodes)
+    order = np.argsort(first_nodes, kind='stable')
+    sorted_first_nodes = first_nodes[order]
+    left = np.searchsorted(sorted_first_nodes, last_nodes, side='left')
+    right = np.searchsorted(sorted_first_nodes, last_nodes, side='right')
+    n_matches = np.where(first_nodes == last_nodes, 0, right - left)
+
+    toseg = np.full(len(last_nodes), -1, dtype=np.int64)
+    found = n_matches > 0
+    toseg[found] = order[left[found]]
+
+    branching = {}
+    for i in np.flatnonzero(n_matches > 1):
+        branching[int(i)] = order[left[i]:right[i]].tolist()
+    if branching and fail_on_branching:
+        raise ValueError("Network is branching: segment(s) "
+                         + ", ".join(str(i) for i in list(branching)[:10])
+                         + (" ..." if len(branching) > 10 else "")
+                         + " drain into more than one segment")
+
+    report = {'mouths': np.flatnonzero(~found),
+              'branching': branching}
+    return toseg, report
+
+
+#########################
+# Segment aggregation   #
+#########################
+
+# Each reduction takes the segment offsets followed by one or more node
+# arrays (already gathered along the segment node rows) and returns one
+# value per segment.
+
+def _reduce_mean(offsets, values):
+    return (np.add.reduceat(values, offsets[:-1], dtype=np.float64)
+            / np.diff(offsets))
+
+def _reduce_min(offsets, values):
+    return np.minimum.reduceat(values, offsets[:-1])
+
+def _reduce_max(offsets, values):
+    return np.maximum.reduceat(values, offsets[:-1])
+
+def _reduce_sum(offsets, values):
+    return np.add.reduceat(values, offsets[:-1], dtype=np.float64)
+
+def _reduce_range(offsets, values):
+    return _reduce_max(offsets, values) - _reduce_min(offsets, values)
+
+def _reduce_first(offsets, values):
+    return values[offsets[:-1]]
+
+def _reduce_last(offsets, values):
+    return values[offsets[1:] - 1]
+
+def _reduce_gradient(offsets, rise, run):
+    # NaN for segments of no length (e.g., one-node channels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return _reduce_range(offsets, rise) / _reduce_range(offsets, run)
+
+REDUCTIONS = {
+    'mean': _reduce_mean,
+    'min': _reduce_min,
+    'max': _reduce_max,
+    'sum': _reduce_sum,
+    'range': _reduce_range,
+    'first': _reduce_first,
+    'last': _reduce_last,
+    'gradient': _reduce_gradient,
+    }
+
+# Segment attributes written by default, in output order:
+# (output column, input column(s), reduction, scale factor)
+SEGMENT_ATTRIBUTES = [
+    ('longitude (mean)', 'longitude', 'mean', 1.),
+    ('latitude (mean)', 'latitude', 'mean', 1.),
+    ('slope', ('elevation', 'flow_distance'), 'gradient', 1.),
+    ('z mean', 'elevation', 'mean', 1.),
+    ('z_max', 'elevation', 'max', 1.),
+    ('z_min', 'elevation', 'min', 1.),
+    ('drainage area (mean) [km2]', 'drainage_area', 'mean', 1E-6),
+    ('chi', 'chi', 'mean', 1.),
+    # Segment normalized steepness index, *assuming this = m_chi from LSDTT*
+    # (This is true for the default A_0 = 1)
+    ('ksn', 'm_chi', 'mean', 1.),
+    ]
+
+
+def parse_attribute(spec):
+    """
+    Turn a user request of the form "COLUMN" or "COLUMN:REDUCTION" (e.g.,
+    "depth_to_bedrock:mean") into a segment-attribute entry. The reduction
+    defaults to the mean.
+    """
+    column, _, reduction = spec.partition(':')
+    reduction = reduction or 'mean'
+    if reduction not in REDUCTIONS or reduction == 'gradient':
+        raise ValueError("Unknown reduction '" + reduction + "' for column '"
+                         + column + "'; choose from: "
+                         + ", ".join(r for r in REDUCTIONS if r != 'gradient'))
+    return (column + ' (' + reduction + ')', column, reduction, 1.)
+
+
+def available_attributes(attributes, available_columns):
+    """
+    The given segment attributes, less the default ones (of
+    SEGMENT_ATTRIBUTES) whose input columns are not all in
+    available_columns (e.g., ksn from a chi_data_map, which has no m_chi).
+    Other attributes are kept, so that their missing columns are reported
+    when read.
+    """
+    return [a for a in attributes
+            if a not in SEGMENT_ATTRIBUTES
+            or all(c in available_columns for c in np.atleast_1d(a[1]))]
+
+
+def network_columns(attributes=SEGMENT_ATTRIBUTES, available_columns=None):
+    """
+    The columns to read to build a network with the given segment
+    attributes: NETWORK_COLUMNS and the attributes' input columns, less the
+    columns of default attributes that are not in available_columns (if
+    given).
+    """
+    default_columns = set(np.concatenate([np.atleast_1d(a[1])
+                                          for a in SEGMENT_ATTRIBUTES]))
+    columns = [c for c in NETWORK_COLUMNS
+               if available_columns is None or c in available_columns
+               or c not in default_columns]
+    for _name, _columns, _reduction, _scale in attributes:
+        columns += [c for c in np.atleast_1d(_columns).tolist()
+                    if c not in columns]
+    return columns
+
+
+def aggregate_segments(node_table, segment_rows, offsets,
+                       attributes=SEGMENT_ATTRIBUTES):
+    """
+    Compute all segment attributes in one pass over the segment index.
+
+    node_table is anything that gives a node array by column name (e.g.,
+    a DataFrame). Each input column is gathered along segment_rows once,
+    and each attribute is a single vectorized reduction over the segment
+    offsets. Returns a dict of output column -> per-segment array, in the
+    order of attributes.
+    """
+    gathered = {}
+    def _gather(column):
+        if column not in gathered:
+            gathered[column] = np.asarray(node_table[column])[segment_rows]
+        return gathered[column]
+
+    out = {}
+    for name, columns, reduction, scale in attributes:
+        if isinstance(columns, str):
+            columns = (columns,)
+        values = REDUCTIONS[reduction](offsets,
+                                       *[_gather(c) for c in columns])
+        out[name] = values * scale if scale != 1 else values
+    return out
+
+
+
+######################
+# Reach subdivision  #
+######################
+
+# Reach attributes: the length of each reach, and then those of the segments
+REACH_ATTRIBUTES = [('length [m]', 'flow_distance', 'range', 1.)] \
+                   + SEGMENT_ATTRIBUTES
+
+
+def subdivide_segments(network, reach_length, attributes=REACH_ATTRIBUTES):
+    """
+    Split every segment of a network (as given by build_network) into
+    reaches of equal flow length, as close to reach_length as a whole
+    number of them (at least one) allows.
+
+    The nodes are binned by their flow distance below the top of their
+    segment, all at once over the segment index. Like segments, each reach
+    includes as its downstream-most node the upstream-most node of the
+    next reach (or the segment's own last node), so that reaches join up.
+
+    Default attributes whose columns are not in the node table (e.g., ksn
+    in a network built from a chi_data_map) are left out (see
+    available_attributes).
+
+    Returns a dict holding:
+      'reach_offsets', 'reach_rows': the reach index (CSR), into the nodes
+      'reaches': DataFrame of reach 'id', 'segment_id', 'toreach' (the
+          reach downstream; -1 at mouths), 'from_node' and 'to_node' (the
+          node IDs at its upstream and downstream ends) and attributes
+    """
+    import pandas as pd
+
+    rp = network['nodes']
+    attributes = available_attributes(attributes,
+                                      ['node'] + list(rp.columns))
+    segment_offsets = network['segment_offsets']
+    segment_rows = network['segment_rows']
+    toseg = network['toseg']
+    n_segments = len(toseg)
+    lengths = np.diff(segment_offsets)
+
+    # Flow distance below the top of the segment, for each segment node
+    flow_distance = np.asarray(rp['flow_distance'],
+                               dtype=np.float64)[segment_rows]
+    node_segment = np.repeat(np.arange(n_segments), lengths)
+    below_top = flow_distance[segment_offsets[:-1]][node_segment] \
+                - flow_distance
+    segment_length = below_top[segment_offsets[1:] - 1]
+    n_reaches = np.maximum(1, np.rint(segment_length / reach_length)) \
+                  .astype(np.int64)
+    bin_length = segment_length / n_reaches
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reach_bin = np.floor(below_top / bin_length[node_segment])
+    reach_bin = np.clip(np.nan_to_num(reach_bin), 0,
+                        (n_reaches - 1)[node_segment]).astype(np.int64)
+
+    # A reach starts at the top of each segment and wherever the bin
+    # changes, except at the last node of a segment, which only closes the
+    # reach above it
+    is_start = np.zeros(len(segment_rows), dtype=bool)
+    is_start[1:] = reach_bin[1:] != reach_bin[:-1]
+    is_start[segment_offsets[1:] - 1] = False
+    is_start[segment_offsets[:-1]] = True
+    starts = np.flatnonzero(is_start)
+    reach_segment = node_segment[starts]
+
+    # Each reach runs to the start of the next one in its segment, or to
+    # the end of the segment
+    ends = np.empty_like(starts)
+    ends[:-1] = starts[1:]
+    last_in_segment = np.ones(len(starts), dtype=bool)
+    last_in_segment[:-1] = reach_segment[1:] != reach_segment[:-1]
+    ends[last_in_segment] = segment_offsets[1:][
+                                reach_segment[last_in_segment]] - 1
+    reach_lengths = ends - starts + 1
+    reach_offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(reach_lengths, out=reach_offsets[1:])
+    reach_rows = segment_rows[np.repeat(starts - reach_offsets[:-1],
+                                        reach_lengths)
+                              + np.arange(reach_offsets[-1])]
+
+    # Link each reach to the next one down its segment, or to the first
+    # reach of the segment downstream
+    reach_ids = np.arange(len(starts))
+    first_reach = np.flatnonzero(np.r_[True, last_in_segment[:-1]])
+    toreach = np.where(last_in_segment, -1, reach_ids + 1)
+    _downstream = toseg[reach_segment[last_in_segment]]
+    toreach[last_in_segment] = np.where(_downstream >= 0,
+                                        first_reach[_downstream], -1)
+
+    node_ids = rp.index.values
+    reaches = pd.DataFrame({'id': reach_ids,
+                            'segment_id': reach_segment,
+                            'toreach': toreach,
+                            'from_node': node_ids[reach_rows[
+                                                    reach_offsets[:-1]]],
+                            'to_node': node_ids[reach_rows[
+                                                    reach_offsets[1:] - 1]]})
+    for name, values in aggregate_segments(rp, reach_rows, reach_offsets,
+                                           attributes).items():
+        reaches[name] = values
+
+    return {
+        'reach_offsets': reach_offsets,
+        'reach_rows': reach_rows,
+        'reaches': reaches,
+        }
+
+
+################
+# Path queries #
+################
+
+def toseg_rows(ids, toseg):
+    """
+    Given segment IDs and the ID of the segment that each drains into (in
+    the same order, as in the columns of a segment table), return the row
+    of the downstream segment for each row (-1 where there is none).
+    """
+    import pandas as pd
+
+    return pd.Index(ids).get_indexer(toseg)
+
+
+def downstream_path(receiver_rows, start_row):
+    """
+    Rows of the segments along the flow path from start_row to the mouth,
+    following receiver_rows (as given by toseg_rows). The cost is
+    proportional to the length of the path.
+    """
+    path = [start_row]
+    _row = receiver_rows[start_row]
+    while _row >= 0:
+        if len(path) > len(receiver_rows):
+            raise ValueError("Segment network contains a loop downstream of"
+                             + " row " + str(start_row))
+        path.append(_row)
+        _row = receiver_rows[_row]
+    return np.array(path, dtype=np.int64)
+
+
+def downstream_paths(receiver_rows, start_rows):
+    """
+    Flow paths from each of start_rows to the mouth, as for downstream_path,
+    returned together CSR-style as (offsets, rows).
+
+    Paths in a basin converge downstream, so each resolved path is
+    remembered: once a walk reaches a segment that an earlier path passed
+    through, the rest of the path is copied from that earlier one rather
+    than walked again.
+    """
+    receiver = np.asarray(receiver_rows).tolist()
+    # For each segment row already on an output path: where that path
+    # continues from it in `rows`, and how many segments are left to the
+    # mouth
+    position = {}
+    remaining = {}
+    rows = []
+    offsets = [0]
+    for start_row in np.asarray(start_rows).tolist():
+        prefix = []
+        _row = start_row
+        while _row >= 0 and _row not in position:
+            if len(prefix) > len(receiver):
+                raise ValueError("Segment network contains a loop"
+                                 + " downstream of row " + str(start_row))
+            prefix.append(_row)
+            _row = receiver[_row]
+        if _row >= 0:
+            suffix = rows[position[_row]:position[_row] + remaining[_row]]
+        else:
+            suffix = []
+        start = len(rows)
+        total = len(prefix) + len(suffix)
+        for i, prefix_row in enumerate(prefix):
+            position[prefix_row] = start + i
+            remaining[prefix_row] = total - i
+        rows.extend(prefix)
+        rows.extend(suffix)
+        offsets.append(len(rows))
+    return np.array(offsets, dtype=np.int64), np.array(rows, dtype=np.int64)
+
+
+def headwater_rows(ids, toseg):
+    """Rows of the segments that no other segment drains into."""
+    return np.flatnonzero(~np.isin(ids, toseg))
+
+def upstream_segments(toseg):
+    """
+    The inverse of toseg: for each segment, the segments that drain
+    directly into it, CSR-style as (offsets, ids), in order of ID.
+    """
+    toseg = np.asarray(toseg)
+    drains = np.flatnonzero(toseg >= 0)
+    ids = drains[np.argsort(toseg[drains], kind='stable')]
+    offsets = np.zeros(len(toseg) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(toseg[drains], minlength=len(toseg)),
+              out=offsets[1:])
+    return offsets, ids
+
+
+# Below this many segments, a generation of upstream_topology is cheaper
+# to take one segment at a time than in a vectorized step
+_MIN_GENERATION = 32
+
+
+def upstream_topology(toseg, segment_length, upstream=None):
+    """
+    Stream order and upstream channel length for every segment, from one
+    pass over the segments in topological order (upstream first). upstream
+    is (offsets, ids) as given by upstream_segments, if already known.
+
+    The segments are taken a generation at a time: first all of those with
+    nothing upstream, then all of those whose upstream segments have just
+    been done, and so on, each generation in a single vectorized step.
+    Generations never grow, and once they are narrow (as they are down a
+    long trunk) the rest of the segments are taken one at a time from a
+    queue instead, so that the pass stays linear however deep the network.
+
+    Returns a dict holding:
+      'upstream_offsets', 'upstream_ids': as given by upstream_segments
+      'order': the segment IDs in topological order
+      'strahler', 'shreve': the Strahler and Shreve stream orders
+      'upstream_length': segment_length summed over each segment and
+          everything upstream of it
+    """
+    toseg = np.asarray(toseg)
+    n_segments = len(toseg)
+    if upstream is None:
+        upstream = upstream_segments(toseg)
+    offsets, ids = upstream
+    n_upstream = np.diff(offsets)
+
+    strahler = np.ones(n_segments, dtype=np.int64)
+    shreve = np.ones(n_segments, dtype=np.int64)
+    upstream_length = np.asarray(segment_length, dtype=np.float64).copy()
+    remaining = n_upstream.copy()
+    order = []
+    generation = np.flatnonzero(remaining == 0)
+    while len(generation) >= _MIN_GENERATION:
+        # Those with tributaries take their values from them, all of which
+        # are done
+        _joins = generation[n_upstream[generation] > 0]
+        if len(_joins):
+            _counts = n_upstream[_joins]
+            _starts = np.zeros(len(_joins), dtype=np.int64)
+            np.cumsum(_counts[:-1], out=_starts[1:])
+            _tributaries = ids[np.repeat(offsets[_joins] - _starts, _counts)
+                               + np.arange(_counts.sum())]
+            _max_order = np.maximum.reduceat(strahler[_tributaries],
+                                             _starts)
+            _n_max = np.add.reduceat(strahler[_tributaries]
+                                     == np.repeat(_max_order, _counts),
+                                     _starts)
+            strahler[_joins] = _max_order + (_n_max > 1)
+            shreve[_joins] = np.add.reduceat(shreve[_tributaries], _starts)
+            upstream_length[_joins] += np.add.reduceat(
+                                        upstream_length[_tributaries],
+                                        _starts)
+        order.append(generation)
+        # The next generation: those whose last upstream segment was in
+        # this one
+        _downstream = toseg[generation]
+        _downstream = _downstream[_downstream >= 0]
+        np.subtract.at(remaining, _downstream, 1)
+        _downstream = np.unique(_downstream)
+        generation = _downstream[remaining[_downstream] == 0]
+
+    if len(generation):
+        # The rest, one segment at a time (Kahn's algorithm), in plain
+        # Python lists
+        _strahler = strahler.tolist()
+        _shreve = shreve.tolist()
+        _length = upstream_length.tolist()
+        _remaining = remaining.tolist()
+        _offsets = offsets.tolist()
+        _ids = ids.tolist()
+        _toseg = toseg.tolist()
+        queue = generation.tolist()
+        for i in queue:
+            _tributaries = _ids[_offsets[i]:_offsets[i+1]]
+            if _tributaries:
+                _orders = [_strahler[t] for t in _tributaries]
+                _max_order = max(_orders)
+                _strahler[i] = _max_order + (_orders.count(_max_order) > 1)
+                _shreve[i] = sum([_shreve[t] for t in _tributaries])
+                _length[i] += sum([_length[t] for t in _tributaries])
+            _down = _toseg[i]
+            if _down >= 0:
+                _remaining[_down] -= 1
+                if _remaining[_down] == 0:
+                    queue.append(_down)
+        strahler = np.array(_strahler, dtype=np.int64)
+        shreve = np.array(_shreve, dtype=np.int64)
+        upstream_length = np.array(_length, dtype=np.float64)
+        order.append(np.array(queue, dtype=np.int64))
+
+    order = np.concatenate(order) if order else np.array([], dtype=np.int64)
+    if len(order) < n_segments:
+        raise ValueError("Segment network contains a loop")
+    return {
+        'upstream_offsets': offsets,
+        'upstream_ids': ids,
+        'order': order,
+        'strahler': strahler,
+        'shreve': shreve,
+        'upstream_length': upstream_length,
+        }
+
+##########
+# Output #
+##########
+
+def node_types(n_rows, channel_head_rows, confluence_rows, at_mouth):
+    """
+    Classify each row of the node table as a 'channel head', 'confluence'
+    (the upstream-most node below a tributary junction), 'mouth' or
+    'interior' node. Mouths take precedence over confluences, and these
+    over channel heads.
+    """
+    types = np.full(n_rows, 'interior', dtype=object)
+    types[channel_head_rows] = 'channel head'
+    types[confluence_rows] = 'confluence'
+    types[np.asarray(at_mouth, dtype=bool)] = 'mouth'
+    return types
+
+
+def write_gpkg(gdf, path, layer=None, append=False):
+    """
+    Write a GeoDataFrame to a GeoPackage, through pyogrio's Arrow interface
+    when pyogrio and pyarrow are available, and otherwise through
+    GeoDataFrame.to_file. If append is set, add the rows to an existing
+    layer rather than overwriting the file.
+    """
+    try:
+        import pyogrio
+        import pyarrow
+    except ImportError:
+        gdf.to_file(path, layer=layer, driver="GPKG",
+                    mode='a' if append else 'w', SPATIAL_INDEX='YES')
+    else:
+        pyogrio.write_dataframe(gdf, path, layer=layer, driver="GPKG",
+                                append=append, use_arrow=True,
+                                layer_options={'SPATIAL_INDEX': 'YES'})
+
+
+def gpkg_layer_name(path, layer=None):
+    """The name GDAL gives a layer written without one: the file's stem."""
+    if layer is not None:
+        return layer
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def index_gpkg(path, layer=None, columns=()):
+    """
+    Create SQLite indexes on attribute columns of a GeoPackage layer (e.g.,
+    'id' and 'toseg'), so that queries on them need not scan the table.
+    The R-tree spatial index is made by write_gpkg as the layer is written.
+    """
+    import sqlite3
+
+    layer = gpkg_layer_name(path, layer)
+    con = sqlite3.connect(path)
+    try:
+        with con:
+            for column in columns:
+                con.execute('CREATE INDEX IF NOT EXISTS "idx_' + layer + '_'
+                            + column + '" ON "' + layer + '" ("' + column
+                            + '")')
+    finally:
+        con.close()
+
+
+METADATA_TABLE = 'lsdtt_network_metadata'
+
+
+def network_metadata(network):
+    """Summary counts and basin keys of a network, for write_gpkg_metadata."""
+    return {
+        'basin_keys': ','.join(str(k) for k in
+                               np.unique(network['nodes']['basin_key'])),
+        'segments': len(network['toseg']),
+        'nodes': len(network['nodes']),
+        'segment_nodes': len(network['segment_rows']),
+        'channel_heads': len(network['channel_head_rows']),
+        'confluences': len(network['confluence_rows']),
+        'mouths': int(np.sum(network['at_mouth'])),
+        }
+
+
+def basin_digests(node_table, columns=None):
+    """
+    Content hash (BLAKE2b) of the rows of each basin in a node table: of
+    their node IDs and the given columns (all if None), in the order in
+    which they were read. Returns a dict of basin_key -> hex digest, in
+    order of basin key. Recorded with the outputs, these tell which basins
+    of an input have changed since the outputs were written.
+    """
+    if columns is None:
+        columns = list(node_table.columns)
+    columns = [c for c in columns if c != 'node']
+    keys = node_table['basin_key'].values
+    order = np.argsort(keys, kind='stable')
+    unique_keys, starts = np.unique(keys[order], return_index=True)
+    ends = np.append(starts[1:], len(keys))
+    arrays = []
+    for values in [node_table.index.values] + [node_table[c].values
+                                               for c in columns]:
+        values = np.asarray(values)[order]
+        if values.dtype == object:
+            values = values.astype(str)
+        arrays.append(values)
+    digests = {}
+    for key, start, end in zip(unique_keys, starts, ends):
+        h = hashlib.blake2b(digest_size=20)
+        for name, values in zip(['node'] + columns, arrays):
+            h.update(name.encode())
+            h.update(values[start:end].tobytes())
+        digests[int(key)] = h.hexdigest()
+    return digests
+
+
+def write_gpkg_metadata(path, layer, metadata):
+    """
+    Record key-value metadata for a layer in the GeoPackage's
+    lsdtt_network_metadata table (registered as an attributes table, so GIS
+    software lists it), replacing any earlier values for that layer.
+    """
+    import sqlite3
+
+    layer = gpkg_layer_name(path, layer)
+    con = sqlite3.connect(path)
+    try:
+        with con:
+            con.execute('CREATE TABLE IF NOT EXISTS ' + METADATA_TABLE
+                        + ' (fid INTEGER PRIMARY KEY AUTOINCREMENT,'
+                        + ' layer TEXT NOT NULL, key TEXT NOT NULL,'
+                        + ' value TEXT, UNIQUE (layer, key))')
+            con.execute("INSERT OR IGNORE INTO gpkg_contents"
+                        + " (table_name, data_type, identifier)"
+                        + " VALUES (?, 'attributes', ?)",
+                        (METADATA_TABLE, METADATA_TABLE))
+            con.executemany('INSERT OR REPLACE INTO ' + METADATA_TABLE
+                            + ' (layer, key, value) VALUES (?, ?, ?)',
+                            [(layer, key, str(value))
+                             for key, value in metadata.items()])
+    finally:
+        con.close()
+
+
+def read_gpkg_metadata(path, layer=None):
+    """
+    The metadata recorded for a layer of a GeoPackage by
+    write_gpkg_metadata, as a dict of key -> value (text); empty if there is
+    no such file, table or layer.
+    """
+    import sqlite3
+
+    if not os.path.exists(path):
+        return {}
+    layer = gpkg_layer_name(path, layer)
+    con = sqlite3.connect(path)
+    try:
+        rows = con.execute('SELECT key, value FROM ' + METADATA_TABLE
+                           + ' WHERE layer = ?', (layer,)).fetchall()
+    except sqlite3.Error:
+        rows = []
+    finally:
+        con.close()
+    return dict(rows)
+
+
+def write_network(network, path, nodes_path=None, layer=None,
+                  metadata=None, reach_length=None,
+                  reach_attributes=REACH_ATTRIBUTES,
+                  node_batch_size=1000000):
+    """
+    Write the segments of a network (as given by build_network) to a
+    GeoPackage layer, with their upstream topology (see upstream_topology)
+    as further columns, and, if given, metadata (e.g., the source file)
+    alongside network_metadata.
+
+    If reach_length is given, the segments are also subdivided into reaches
+    (see subdivide_segments) with reach_attributes, in their own layer,
+    "reaches" (or "<layer>_reaches"). If nodes_path is given, the nodes of
+    every segment are written there, node_batch_size at a time, labelled
+    with their segment and network node type.
+    """
+    import geopandas as gpd
+    import shapely
+
+    rp = network['nodes']
+    segment_offsets = network['segment_offsets']
+    segment_rows = network['segment_rows']
+    toseg = network['toseg']
+    segment_ids = np.arange(len(toseg))
+
+    with profile_stage('topology', segments=len(toseg)):
+        # Upstream topology: the segments draining directly into each one,
+        # its Strahler and Shreve orders, and the channel length of it and
+        # all upstream of it
+        dfsegs = network['segments'].copy()
+        _length = aggregate_segments(rp, segment_rows, segment_offsets,
+                                     [REACH_ATTRIBUTES[0]])
+        topology = upstream_topology(
+                    toseg, _length['length [m]'],
+                    upstream=(network['upstream_offsets'],
+                              network['upstream_ids'])
+                             if 'upstream_ids' in network else None)
+        _upstream_ids = topology['upstream_ids'].astype(str)
+        _upstream_offsets = topology['upstream_offsets']
+        dfsegs['fromseg'] = [','.join(_upstream_ids[_upstream_offsets[i]:
+                                                    _upstream_offsets[i+1]])
+                             for i in segment_ids]
+        dfsegs['length [m]'] = _length['length [m]']
+        dfsegs['upstream length [m]'] = topology['upstream_length']
+        dfsegs['strahler'] = topology['strahler']
+        dfsegs['shreve'] = topology['shreve']
+
+    with profile_stage('geometry', segments=len(toseg)):
+        # Create the LineString objects in bulk from the flat coordinate
+        # array, telling shapely which segment each node belongs to
+        _coords = rp[['longitude', 'latitude', 'elevation']] \
+                    .values[segment_rows]
+        stream_lines = shapely.linestrings(_coords,
+                        indices=np.repeat(segment_ids,
+                                          np.diff(segment_offsets)))
+
+        # Now convert to geopandas
+        gdf_segs = gpd.GeoDataFrame( dfsegs, geometry=stream_lines,
+                                     crs="EPSG:4326")
+
+    with profile_stage('write segments', segments=len(toseg)):
+        # Save to GeoPackage, indexing the segment IDs and recording what
+        # the network was built from
+        write_gpkg(gdf_segs, path, layer=layer)
+        index_gpkg(path, layer, ['id', 'toseg', 'strahler'])
+        _metadata = dict(metadata or {}, **network_metadata(network))
+        write_gpkg_metadata(path, layer, _metadata)
+
+    if reach_length is not None:
+        # Reaches, as their own layer alongside the segments
+        with profile_stage('reaches') as counts:
+            subdivision = subdivide_segments(network, reach_length,
+                                             reach_attributes)
+            reach_rows = subdivision['reach_rows']
+            reach_lines = shapely.linestrings(
+                            rp[['longitude', 'latitude', 'elevation']]
+                                .values[reach_rows],
+                            indices=np.repeat(
+                                np.arange(len(subdivision['reaches'])),
+                                np.diff(subdivision['reach_offsets'])))
+            gdf_reaches = gpd.GeoDataFrame(subdivision['reaches'],
+                                           geometry=reach_lines,
+                                           crs="EPSG:4326")
+            _reach_layer = 'reaches' if layer is None \
+                           else layer + '_reaches'
+            write_gpkg(gdf_reaches, path, layer=_reach_layer)
+            index_gpkg(path, _reach_layer, ['id', 'toreach', 'segment_id'])
+            write_gpkg_metadata(path, _reach_layer,
+                                dict(_metadata, reach_length=reach_length,
+                                     reaches=len(gdf_reaches)))
+            counts['reaches'] = len(gdf_reaches)
+
+    if nodes_path is None:
+        return
+
+    # Export nodes for use of plotting
+    # Built directly from the node table, repeating junction nodes as they
+    # appear in each segment, and written in batches so that only one
+    # batch of rows is ever copied out of rp. "toseg" here is the node ID
+    # at the downstream end of each segment.
+    with profile_stage('write nodes', nodes=len(segment_rows)):
+        _node_segment_ids = np.repeat(segment_ids, np.diff(segment_offsets))
+        _node_toseg = np.repeat(rp.index.values[
+                                    segment_rows[segment_offsets[1:] - 1]],
+                                np.diff(segment_offsets))
+        _node_types = node_types(len(rp), network['channel_head_rows'],
+                                 network['confluence_rows'],
+                                 network['at_mouth'])
+        for _start in range(0, len(segment_rows), node_batch_size):
+            _batch = slice(_start, _start + node_batch_size)
+            _rows = segment_rows[_batch]
+            dfnodes = rp.iloc[_rows].reset_index()
+            dfnodes['segment_id'] = _node_segment_ids[_batch]
+            dfnodes['toseg'] = _node_toseg[_batch]
+            dfnodes['network_node_type'] = _node_types[_rows]
+            gdf_NetworkNodes = gpd.GeoDataFrame( dfnodes,
+                                geometry=shapely.points(dfnodes[[
+                                    'longitude', 'latitude',
+                                    'elevation']].values),
+                                crs="EPSG:4326")
+            write_gpkg(gdf_NetworkNodes, nodes_path, layer=layer,
+                       append=(_start > 0))
+        index_gpkg(nodes_path, layer, ['segment_id', 'node'])
+        write_gpkg_metadata(nodes_path, layer, _metadata)
+
+
+####################
+# Network building #
+####################
+
+def build_network(node_table, attributes=SEGMENT_ATTRIBUTES,
+                  fail_on_branching=False, receiver_rows=None):
+    """
+    Build the segment network from a node table indexed by node ID (as
+    given by read_node_table). If the row of each node's receiver is
+    already known (e.g., from a node store), it can be given as
+    receiver_rows, rather than looked up.
+
+    Returns a dict holding:
+      'nodes': a copy of the node table, with a 'receiver_source_key'
+          column added
+      'receiver_rows': the row of each node's receiver (-1 if off the map)
+      'at_mouth': mask of river-mouth rows
+      'channel_head_rows', 'confluence_rows': rows of these nodes
+      'segment_offsets', 'segment_rows': the segment index (CSR)
+      'toseg': the segment that each segment drains into (-1 at mouths)
+      'upstream_offsets', 'upstream_ids': the segments that drain directly
+          into each segment (CSR; see upstream_segments)
+      'segments': DataFrame of segment 'id', 'toseg' and attributes
+      'report': the diagnostics from resolve_toseg
+    """
+    import pandas as pd
+
+    rp = node_table
+
+    # Map each node's receiver to its row in the table. Receivers that are
+    # not in the table (off the map or outside the selected basin) come
+    # back as -1, and nodes that are their own receivers are flagged
+    # alongside them: these are the river mouths.
+    with profile_stage('receivers', nodes=len(rp)) as counts:
+        if receiver_rows is None:
+            receiver_rows = rp.index.get_indexer(rp['receiver_node'])
+        at_mouth = (receiver_rows == -1) \
+                   | (receiver_rows == np.arange(len(rp)))
+        counts['mouths'] = int(at_mouth.sum())
+
+        # Get the source key for all receiver nodes in a single gather
+        # This will show the upstream limit(s) of confluences, and provide
+        # the node IDs of these confluences.
+        receiver_source_key = rp['source_key'].values[receiver_rows]
+        receiver_source_key[at_mouth] = -1
+
+    # Next, identify these confluences by places where the
+    # receiver_source_key differs from the source_key, and remove river
+    # mouths
+    with profile_stage('junctions') as counts:
+        confluence_downstream_nodes = np.setdiff1d(
+                                        rp['receiver_node'].values
+                                            [rp['source_key'].values !=
+                                             receiver_source_key],
+                                        rp['receiver_node'].values[at_mouth])
+        confluence_rows = rp.index.get_indexer(confluence_downstream_nodes)
+
+        # Obtain channel-head locations
+        # The channel head is the first node listed for each source key
+        _, channel_head_rows = np.unique(rp['source_key'].values,
+                                         return_index=True)
+        counts['confluences'] = len(confluence_rows)
+        counts['channel_heads'] = len(channel_head_rows)
+
+    # Segment sources include all channel heads (true "sources") and
+    # confluences; terminations include all confluence and mouth nodes
+    source_rows = np.hstack(( channel_head_rows, confluence_rows ))
+    is_termination = at_mouth.copy()
+    is_termination[confluence_rows] = True
+
+    # Trace each segment down the network, giving the rows of its nodes.
+    # Each segment will include as its downstream-most cell the
+    # upstream-most node from the next tributary junction.
+    with profile_stage('tracing') as counts:
+        segment_offsets, segment_rows = trace_segments(
+                                            receiver_rows, is_termination,
+                                            source_rows)
+        counts['segments'] = len(segment_offsets) - 1
+        counts['segment_nodes'] = len(segment_rows)
+
+    # Link each segment to the one downstream, by way of the node IDs at
+    # either end
+    with profile_stage('linkage') as counts:
+        toseg, report = resolve_toseg(
+                            rp.index.values[segment_rows[
+                                                segment_offsets[:-1]]],
+                            rp.index.values[segment_rows[
+                                                segment_offsets[1:]-1]],
+                            fail_on_branching=fail_on_branching)
+        counts['branching'] = len(report['branching'])
+        upstream_offsets, upstream_ids = upstream_segments(toseg)
+
+    with profile_stage('aggregation', attributes=len(attributes)):
+        segments = pd.DataFrame({'id': np.arange(len(toseg)),
+                                 'toseg': toseg})
+        for name, values in aggregate_segments(rp, segment_rows,
+                                               segment_offsets,
+                                               attributes).items():
+            segments[name] = values
+
+    # The column is added to a new table, leaving the caller's alone
+    return {
+        'nodes': rp.assign(receiver_source_key=receiver_source_key),
+        'receiver_rows': receiver_rows,
+        'at_mouth': at_mouth,
+        'channel_head_rows': channel_head_rows,
+        'confluence_rows': confluence_rows,
+        'segment_offsets': segment_offsets,
+        'segment_rows': segment_rows,
+        'toseg': toseg,
+        'upstream_offsets': upstream_offsets,
+        'upstream_ids': upstream_ids,
+        'segments': segments,
+        'report': report,
+        }
+
+
+def select_basin(network, basin_key):
+    """
+    Cut the network built from a whole file down to a single basin,
+    renumbering node rows and segment IDs as if the network had been built
+    from that basin alone. Basins are independent drainage trees, so no
+    segment or receiver crosses from one to another.
+    """
+    nodes = network['nodes']
+    keep_rows = nodes['basin_key'].values == basin_key
+    new_row = np.cumsum(keep_rows) - 1
+    new_row[~keep_rows] = -1
+
+    offsets = network['segment_offsets']
+    segment_rows = network['segment_rows']
+    keep_segments = keep_rows[segment_rows[offsets[:-1]]]
+    new_id = np.cumsum(keep_segments) - 1
+    new_id[~keep_segments] = -1
+    lengths = np.diff(offsets)[keep_segments]
+
+    receiver_rows = network['receiver_rows'][keep_rows]
+    receiver_rows = np.where(receiver_rows >= 0, new_row[receiver_rows], -1)
+    toseg = network['toseg'][keep_segments]
+    toseg = np.where(toseg >= 0, new_id[toseg], -1)
+    segments = network['segments'][keep_segments].reset_index(drop=True)
+    segments['id'] = np.arange(len(segments))
+    segments['toseg'] = toseg
+
+    def _rows(rows):
+        return new_row[rows][keep_rows[rows]]
+
+    branching = {}
+    for i, candidates in network['report']['branching'].items():
+        if keep_segments[i]:
+            branching[int(new_id[i])] = new_id[candidates].tolist()
+
+    upstream_offsets, upstream_ids = upstream_segments(toseg)
+    return {
+        'nodes': nodes[keep_rows],
+        'receiver_rows': receiver_rows,
+        'at_mouth': network['at_mouth'][keep_rows],
+        'channel_head_rows': _rows(network['channel_head_rows']),
+        'confluence_rows': _rows(network['confluence_rows']),
+        'segment_offsets': np.concatenate(([0], np.cumsum(lengths))),
+        'segment_rows': new_row[segment_rows[
+                                np.repeat(keep_segments, np.diff(offsets))]],
+        'toseg': toseg,
+        'upstream_offsets': upstream_offsets,
+        'upstream_ids': upstream_ids,
+        'segments': segments,
+        'report': {'mouths': np.flatnonzero(toseg == -1),
+                   'branching': branching},
+        }
+
+
+
+def _reorder_segments(network, order):
+    """Renumber the segments of a network so that segment i is order[i]."""
+    offsets = network['segment_offsets']
+    lengths = np.diff(offsets)[order]
+    new_offsets = np.concatenate(([0], np.cumsum(lengths)))
+    positions = np.repeat(offsets[:-1][order] - new_offsets[:-1], lengths) \
+                + np.arange(new_offsets[-1])
+    new_id = np.empty(len(order), dtype=np.int64)
+    new_id[order] = np.arange(len(order))
+    toseg = network['toseg'][order]
+    toseg = np.where(toseg >= 0, new_id[toseg], -1)
+    segments = network['segments'].iloc[order].reset_index(drop=True)
+    segments['id'] = np.arange(len(segments))
+    segments['toseg'] = toseg
+    branching = {}
+    for i, candidates in network['report']['branching'].items():
+        branching[int(new_id[i])] = new_id[candidates].tolist()
+    upstream_offsets, upstream_ids = upstream_segments(toseg)
+    return dict(network,
+                segment_offsets=new_offsets,
+                segment_rows=network['segment_rows'][positions],
+                toseg=toseg,
+                upstream_offsets=upstream_offsets,
+                upstream_ids=upstream_ids,
+                segments=segments,
+                report={'mouths': np.flatnonzero(toseg == -1),
+                        'branching': branching})
+
+
+def merge_networks(networks):
+    """
+    Combine networks built from separate basins into one, with globally
+    unique node rows and segment IDs. Segments are numbered as
+    build_network would number them for all of the basins at once:
+    channel-head segments first, in order of source key, and then
+    confluence segments, in order of the node ID at their upstream ends.
+    """
+    import pandas as pd
+
+    row_shift = np.cumsum([0] + [len(n['nodes']) for n in networks])
+    seg_shift = np.cumsum([0] + [len(n['toseg']) for n in networks])
+
+    def _shift(arrays, shifts):
+        return np.concatenate([np.where(a >= 0, a + shift, a)
+                               for a, shift in zip(arrays, shifts)])
+
+    offsets = [networks[0]['segment_offsets'][:1]] + \
+              [n['segment_offsets'][1:] + n_shift
+               for n, n_shift in zip(networks,
+                   np.cumsum([0] + [len(n['segment_rows'])
+                                    for n in networks]))]
+    branching = {}
+    for n, shift in zip(networks, seg_shift):
+        for i, candidates in n['report']['branching'].items():
+            branching[i + int(shift)] = [c + int(shift) for c in candidates]
+    nodes = pd.concat([n['nodes'] for n in networks])
+    merged = {
+        'nodes': nodes,
+        'receiver_rows': _shift([n['receiver_rows'] for n in networks],
+                                row_shift),
+        'at_mouth': np.concatenate([n['at_mouth'] for n in networks]),
+        'channel_head_rows': _shift([n['channel_head_rows']
+                                     for n in networks], row_shift),
+        'confluence_rows': _shift([n['confluence_rows'] for n in networks],
+                                  row_shift),
+        'segment_offsets': np.concatenate(offsets),
+        'segment_rows': _shift([n['segment_rows'] for n in networks],
+                               row_shift),
+        'toseg': _shift([n['toseg'] for n in networks], seg_shift),
+        'segments': pd.concat([n['segments'] for n in networks],
+                              ignore_index=True),
+        'report': {'branching': branching},
+        }
+
+    # Put the segments back in the order of a single build
+    first_rows = merged['segment_rows'][merged['segment_offsets'][:-1]]
+    is_head = np.concatenate([np.arange(len(n['toseg']))
+                                < len(n['channel_head_rows'])
+                              for n in networks])
+    head_key = np.where(is_head, nodes['source_key'].values[first_rows], 0)
+    confluence_key = np.where(is_head, 0, nodes.index.values[first_rows])
+    order = np.lexsort((confluence_key, head_key, ~is_head))
+    return _reorder_segments(merged, order)
+
+
+def fork_context():
+    """
+    The multiprocessing context in which to start worker processes:
+    "fork", or None where processes cannot be forked (e.g., on Windows).
+    Workers are never spawned instead, because the command-line tools are
+    plain scripts, which spawned workers would re-run on import.
+    """
+    import multiprocessing
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def build_networks_by_basin(node_table, jobs=1, node_store=None, **kwargs):
+    """
+    Build a separate network for each basin in node_table, returning a dict
+    of basin_key -> network in order of first appearance. Basins are built
+    in turn, or in parallel across a pool of `jobs` worker processes (one
+    per CPU if jobs is None) where processes can be forked (see
+    fork_context). Keyword arguments are passed to build_network.
+
+    If node_table comes from a node store (see open_node_store), possibly
+    cut down to some basins, the path of the store can be given as
+    node_store. Worker processes then open the store themselves, sharing
+    its pages, and are sent the rows of their basins, rather than the
+    basins' nodes; and they send back all but the nodes of each network.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    mp_context = None if jobs is not None and jobs <= 1 else fork_context()
+    if node_store is not None and mp_context is not None:
+        # Rows of each basin, in order of first appearance, and where they
+        # are in the store
+        basin_keys = node_table['basin_key'].values
+        unique_keys, first_rows, inverse = np.unique(
+            basin_keys, return_index=True, return_inverse=True)
+        rows = np.split(np.argsort(inverse, kind='stable'),
+                        np.cumsum(np.bincount(inverse))[:-1])
+        appearance = np.argsort(first_rows)
+        keys = [int(unique_keys[i]) for i in appearance]
+        basin_rows = [rows[i] for i in appearance]
+        store_rows = open_node_store(node_store, columns=[])['nodes'] \
+                        .index.get_indexer(node_table.index)
+        if np.any(store_rows < 0):
+            raise ValueError("Nodes not in node store " + node_store)
+        columns = list(node_table.columns)
+        with profile_stage('build (workers)', basins=len(keys), jobs=jobs,
+                           node_store=True), \
+             ProcessPoolExecutor(max_workers=jobs,
+                                 mp_context=mp_context) as executor:
+            results = executor.map(_build_network_store_worker,
+                                   [node_store] * len(keys),
+                                   [columns] * len(keys),
+                                   [store_rows[r] for r in basin_rows],
+                                   [kwargs] * len(keys))
+            networks = []
+            for _rows, (receiver_source_key, network) in zip(basin_rows,
+                                                             results):
+                network['nodes'] = node_table.iloc[_rows].assign(
+                                    receiver_source_key=receiver_source_key)
+                networks.append(network)
+        return dict(zip(keys, networks))
+
+    keys = []
+    basins = []
+    for key, basin in node_table.groupby('basin_key', sort=False):
+        keys.append(int(key))
+        basins.append(basin)
+
+    if mp_context is None:
+        networks = [build_network(basin, **kwargs) for basin in basins]
+    else:
+        # The stages within each worker are not seen here, so the whole
+        # build is profiled as one stage
+        with profile_stage('build (workers)', basins=len(basins),
+                           jobs=jobs), \
+             ProcessPoolExecutor(max_workers=jobs,
+                                 mp_context=mp_context) as executor:
+            networks = list(executor.map(_build_network_worker, basins,
+                                         [kwargs] * len(basins)))
+    return dict(zip(keys, networks))
+
+
+def build_network_by_basin(node_table, jobs=None, **kwargs):
+    """
+    Build the network of each basin in node_table in parallel, across
+    a pool of `jobs` worker processes (one per CPU by default), and merge
+    the results. Keyword arguments (e.g., node_store) are passed to
+    build_networks_by_basin and build_network.
+    """
+    networks = list(build_networks_by_basin(node_table, jobs,
+                                            **kwargs).values())
+    with profile_stage('merge', basins=len(networks)):
+        return merge_networks(networks)
+
+
+def _build_network_worker(node_table, kwargs):
+    return build_network(node_table, **kwargs)
+
+
+# Node stores opened by this (worker) process, by path and columns
+_worker_node_stores = {}
+
+
+def _build_network_store_worker(node_store, columns, rows, kwargs):
+    key = (node_store, tuple(columns))
+    if key not in _worker_node_stores:
+        _worker_node_stores[key] = open_node_store(node_store, columns)
+    store = _worker_node_stores[key]
+    network = build_network(store['nodes'].iloc[rows],
+                            receiver_rows=_local_rows(
+                                store['receiver_rows'][rows], rows),
+                            **kwargs)
+    # The parent has the basin's nodes already: only the column added to
+    # them here goes back
+    return network.pop('nodes')['receiver_source_key'].values, network
+
+
+def _local_rows(store_rows, rows):
+    # Store rows as rows of the table made of the given store rows (-1 for
+    # those not among them)
+    if len(rows) == 0:
+        return np.full(len(store_rows), -1, dtype=np.int64)
+    order = np.argsort(rows, kind='stable')
+    sorted_rows = rows[order]
+    position = np.minimum(np.searchsorted(sorted_rows, store_rows),
+                          len(rows) - 1)
+    return np.where(sorted_rows[position] == store_rows, order[position], -1)
+
+
+#################
+# Network cache #
+#################
+
+# The network built from an input file can be stored in a binary cache, so
+# that repeat runs (including runs that select a different basin from the
+# same file) skip parsing and tracing. Each entry is an uncompressed .npz
+# file named for a hash of the input file (path, size, modification time
+# and content) and of the options that change the network. The plotter
+# keeps GeoParquet copies of the network GeoPackages in the same way.
+
+CACHE_DIRNAME = '.lsdtt_network_cache'
+_CACHE_DIGESTS = 'digests.json'
+_CACHE_EXTENSIONS = ('.npz', '.parquet')
+
+# Arrays stored under their own names in a cache entry
+_NETWORK_ARRAYS = ['receiver_rows', 'at_mouth', 'channel_head_rows',
+                   'confluence_rows', 'segment_offsets', 'segment_rows',
+                   'toseg', 'upstream_offsets', 'upstream_ids']
+
+
+def default_cache_dir(file_input):
+    """The cache directory kept next to an input file."""
+    return os.path.join(os.path.dirname(os.path.abspath(file_input)),
+                        CACHE_DIRNAME)
+
+
+def file_digest(path, cache_dir=None):
+    """
+    Content hash (BLAKE2b) of a file. If cache_dir is given, digests are
+    remembered there against the file's path, size and modification time,
+    so that an unchanged file is not read again.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    known = {}
+    if cache_dir is not None:
+        try:
+            with open(os.path.join(cache_dir, _CACHE_DIGESTS)) as f:
+                known = json.load(f)
+        except (OSError, ValueError):
+            known = {}
+        if path in known and known[path][:2] == stamp:
+            return known[path][2]
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            h.update(block)
+    digest = h.hexdigest()
+    if cache_dir is not None:
+        known[path] = stamp + [digest]
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, _CACHE_DIGESTS), 'w') as f:
+            json.dump(known, f)
+    return digest
+
+
+def network_cache_path(cache_dir, file_input, extension='.npz', **options):
+    """
+    Path of the cache entry for the network built from file_input with the
+    given options (e.g., basin_key, columns, attributes). Options must be
+    JSON-serializable.
+    """
+    key = json.dumps([os.path.abspath(file_input),
+                      file_digest(file_input, cache_dir), options],
+                     sort_keys=True)
+    return os.path.join(cache_dir,
+                        hashlib.blake2b(key.encode(), digest_size=20)
+                        .hexdigest() + extension)
+
+
+def save_network(network, path):
+    """Write a network (as given by build_network) to a cache entry."""
+    arrays = {name: network[name] for name in _NETWORK_ARRAYS}
+    manifest = {'report': {'branching': network['report']['branching']}}
+    for table in ('nodes', 'segments'):
+        df = network[table]
+        if table == 'nodes':
+            df = df.reset_index()
+        manifest[table] = list(df.columns)
+        for i, column in enumerate(df.columns):
+            values = df[column].values
+            if values.dtype == object:
+                values = values.astype(str)
+            arrays[table + '_' + str(i)] = values
+    arrays['manifest'] = np.array(json.dumps(manifest))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write under a temporary name first so that an interrupted run never
+    # leaves a partial entry behind
+    tmp_path = path + '.part'
+    with profile_stage('cache write'), open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_network(path):
+    """
+    Read a network from a cache entry, or return None if there is no such
+    entry. A hit refreshes the entry's modification time, which sets its
+    place in the eviction order.
+    """
+    import pandas as pd
+
+    if not os.path.exists(path):
+        return None
+    with profile_stage('cache read'), np.load(path) as npz:
+        manifest = json.loads(str(npz['manifest']))
+        network = {name: npz[name] for name in _NETWORK_ARRAYS
+                   if name in npz.files}
+        for table in ('nodes', 'segments'):
+            network[table] = pd.DataFrame({
+                column: npz[table + '_' + str(i)]
+                for i, column in enumerate(manifest[table]) })
+    os.utime(path)
+    network['nodes'] = network['nodes'].set_index('node')
+    if 'upstream_ids' not in network:
+        # Entries written before the upstream segments were kept
+        network['upstream_offsets'], network['upstream_ids'] = \
+            upstream_segments(network['toseg'])
+    network['report'] = {
+        'mouths': np.flatnonzero(network['toseg'] == -1),
+        'branching': {int(k): v for k, v
+                      in manifest['report']['branching'].items()} }
+    return network
+
+
+def _is_cache_entry(name):
+    # Cache entries are named for a 40-digit hexadecimal hash (see
+    # network_cache_path), with one of the cache's own extensions
+    stem, extension = os.path.splitext(name)
+    return extension in _CACHE_EXTENSIONS and len(stem) == 40 \
+        and all(c in '0123456789abcdef' for c in stem)
+
+
+def evict_cache(cache_dir, max_bytes, keep=()):
+    """
+    Delete the least recently used cache entries until the entries in
+    cache_dir take up no more than max_bytes. Only files named as cache
+    entries are counted and deleted, and the entries at the paths in keep
+    (e.g., the one just written) are never deleted.
+    """
+    try:
+        names = [n for n in os.listdir(cache_dir) if _is_cache_entry(n)]
+    except OSError:
+        return
+    keep = {os.path.abspath(path) for path in keep}
+    entries = []
+    for name in names:
+        stat = os.stat(os.path.join(cache_dir, name))
+        entries.append((stat.st_mtime, stat.st_size, name))
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    for _mtime, size, name in entries:
+        if total <= max_bytes:
+            break
+        if os.path.abspath(os.path.join(cache_dir, name)) in keep:
+            continue
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+
+
+def _gpkg_cache_path(cache_dir, path, layer):
+    # Path of the GeoParquet copy of a GeoPackage layer in cache_dir
+    return network_cache_path(cache_dir, path, extension='.parquet',
+                              layer=layer)
+
+
+def _read_parquet_part(cache_path, columns, ids, id_column, read_geometry):
+    # Read part of a GeoParquet copy (see read_gpkg), leaving it to pyarrow
+    # to skip the other columns and row groups
+    import pandas as pd
+    import pyarrow.parquet as pq
+
+    schema = pq.read_schema(cache_path)
+    geometry = json.loads(schema.metadata[b'geo'])['primary_column']
+    if columns is None:
+        columns = [c for c in schema.names if c != geometry]
+    columns = [c for c in columns if c in schema.names and c != geometry]
+    filters = None if ids is None else [(id_column, 'in', ids.tolist())]
+    if read_geometry:
+        import geopandas as gpd
+        return gpd.read_parquet(cache_path, columns=columns + [geometry],
+                                filters=filters)
+    return pd.read_parquet(cache_path, columns=columns, filters=filters)
+
+
+def read_gpkg_cached(path, cache_dir=None, max_bytes=None, layer=None):
+    """
+    Read a GeoPackage layer (by default, the first with geometries; see
+    feature_layer), through a GeoParquet copy in cache_dir if one has been
+    made from the current contents of the file. Without cache_dir (or
+    without pyarrow), this is gpd.read_file.
+    """
+    import geopandas as gpd
+
+    try:
+        import pyarrow
+    except ImportError:
+        cache_dir = None
+    if layer is None:
+        layer = feature_layer(path)
+    if cache_dir is None:
+        return gpd.read_file(path, layer=layer)
+    cache_path = _gpkg_cache_path(cache_dir, path, layer)
+    if os.path.exists(cache_path):
+        os.utime(cache_path)
+        return gpd.read_parquet(cache_path)
+    gdf = gpd.read_file(path, layer=layer)
+    gdf.to_parquet(cache_path + '.part')
+    os.replace(cache_path + '.part', cache_path)
+    if max_bytes is not None:
+        evict_cache(cache_dir, max_bytes, keep=[cache_path])
+    return gdf
+
+
+def feature_layer(path):
+    """
+    Name of the first layer with geometries in a GeoPackage, passing over
+    the lsdtt_network_metadata table (None if it cannot be told).
+    """
+    import geopandas as gpd
+
+    try:
+        layers = gpd.list_layers(path)
+    except AttributeError:
+        return None
+    for name, geometry_type in zip(layers['name'],
+                                   layers['geometry_type']):
+        if geometry_type is not None and name != METADATA_TABLE:
+            return name
+    return None
+
+
+def read_gpkg(path, columns=None, ids=None, id_column='id',
+              read_geometry=True, cache_dir=None, max_bytes=None,
+              layer=None):
+    """
+    Read part of a GeoPackage layer (by default, the first with geometries;
+    see feature_layer): only the given attribute columns (all if None),
+    only the features whose id_column is in ids (all if None), and the
+    geometry only if read_geometry is set.
+
+    With pyogrio, the selection is made by GDAL as it reads, through an
+    SQL "IN" filter, so that nothing else is parsed. Through the cache in
+    cache_dir (as for read_gpkg_cached), the columns and an "in" filter on
+    the ids are handed to the GeoParquet reader in the same way, once the
+    layer's copy has been made; otherwise, the whole layer is read and then
+    cut down. Either way, requested columns that the layer lacks are left
+    out.
+    """
+    if ids is not None:
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if columns is not None:
+        columns = list(columns)
+        if ids is not None and id_column not in columns:
+            columns.append(id_column)
+
+    try:
+        import pyogrio
+    except ImportError:
+        pyogrio = None
+    if pyogrio is not None and cache_dir is None:
+        if ids is not None:
+            where = '"' + id_column + '" IN (' \
+                    + ','.join(str(i) for i in ids.tolist()) + ')'
+        else:
+            where = None
+        if layer is None:
+            layer = feature_layer(path)
+        return pyogrio.read_dataframe(path, layer=layer,
+                                      columns=columns, where=where,
+                                      read_geometry=read_geometry)
+
+    if cache_dir is not None:
+        try:
+            import pyarrow
+        except ImportError:
+            cache_dir = None
+    if cache_dir is not None:
+        if layer is None:
+            layer = feature_layer(path)
+        cache_path = _gpkg_cache_path(cache_dir, path, layer)
+        if os.path.exists(cache_path):
+            os.utime(cache_path)
+            return _read_parquet_part(cache_path, columns, ids, id_column,
+                                      read_geometry).reset_index(drop=True)
+
+    gdf = read_gpkg_cached(path, cache_dir, max_bytes, layer)
+    if ids is not None:
+        gdf = gdf[gdf[id_column].isin(ids)]
+    if columns is not None:
+        gdf = gdf[[c for c in columns if c in gdf.columns]
+                  + ([gdf.geometry.name] if read_geometry else [])]
+    elif not read_geometry:
+        gdf = gdf.drop(columns=gdf.geometry.name)
+    if not read_geometry:
+        import pandas as pd
+        gdf = pd.DataFrame(gdf)
+    return gdf.reset_index(drop=True)
+
+
+##############
+# Node store #
+##############
+
+# The node table read from an input file can also be kept as a directory of
+# .npy arrays, one per column, with the node IDs and the row of each node's
+# receiver, alongside a manifest. open_node_store maps these into memory
+# rather than reading them, so that a store reopens in next to no time
+# whatever its size, and any number of processes can open it at once while
+# sharing one copy of it in the page cache.
+
+_NODE_STORE_MANIFEST = 'manifest.json'
+
+
+def _is_node_store_file(name):
+    # The files that a node store is made of: its manifest and its arrays
+    return name == _NODE_STORE_MANIFEST or name.endswith('.npy')
+
+
+def save_node_store(node_table, path, source=None):
+    """
+    Write a node table (as given by read_node_table) to a node store, a
+    directory at path, replacing any store already there. source is a
+    JSON-serializable description of where the nodes came from (e.g., the
+    input file and its digest), kept in the manifest.
+
+    Only a node store (with its manifest), or an empty directory, is
+    written over, and only the store's own files are replaced: a ValueError
+    is raised if path is a file, or a non-empty directory without a store
+    manifest.
+    """
+    import shutil
+    import tempfile
+
+    path = os.path.abspath(path)
+    if os.path.exists(path):
+        if not os.path.isdir(path):
+            raise ValueError("Node store " + path + " is a file")
+        if os.listdir(path) and not os.path.exists(
+                os.path.join(path, _NODE_STORE_MANIFEST)):
+            raise ValueError("Node store " + path + " is a directory that "
+                             "holds other files; give an empty or new "
+                             "directory")
+
+    with profile_stage('node store write', nodes=len(node_table)):
+        columns = list(node_table.columns)
+        arrays = {'node': node_table.index.values,
+                  'receiver_rows': node_table.index.get_indexer(
+                                    node_table['receiver_node'])}
+        for i, column in enumerate(columns):
+            values = np.asarray(node_table[column].values)
+            if values.dtype == object:
+                values = values.astype(str)
+            arrays['column_' + str(i)] = values
+        # Write to a temporary directory beside the store first, so that an
+        # interrupted run never leaves a partial store behind
+        parent = os.path.dirname(path)
+        os.makedirs(parent, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                                    suffix='.part', dir=parent)
+        try:
+            for name, values in arrays.items():
+                np.save(os.path.join(tmp_path, name + '.npy'),
+                        np.ascontiguousarray(values))
+            with open(os.path.join(tmp_path, _NODE_STORE_MANIFEST),
+                      'w') as f:
+                json.dump({'columns': columns, 'nodes': len(node_table),
+                           'source': source}, f)
+            # Clear out the old store's files (the manifest first, so that
+            # it is never taken for a whole store), and put the new one in
+            # its place: all at once if nothing else is in the directory
+            if os.path.isdir(path):
+                for name in sorted((n for n in os.listdir(path)
+                                    if _is_node_store_file(n)),
+                                   key=lambda n: n != _NODE_STORE_MANIFEST):
+                    os.remove(os.path.join(path, name))
+                if not os.listdir(path):
+                    os.rmdir(path)
+            if os.path.exists(path):
+                for name in sorted(os.listdir(tmp_path),
+                                   key=lambda n: n == _NODE_STORE_MANIFEST):
+                    os.replace(os.path.join(tmp_path, name),
+                               os.path.join(path, name))
+                os.rmdir(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+
+def open_node_store(path, columns=None):
+    """
+    Open a node store (see save_node_store), memory-mapped and read-only,
+    with only the given columns (all if None). Returns a dict holding:
+      'nodes': the node table, indexed by node ID
+      'receiver_rows': the row of each node's receiver (-1 if off the map)
+      'source': the description of the nodes' source
+    or None if there is no store at path, or it lacks any of the columns.
+    """
+    import pandas as pd
+
+    try:
+        with open(os.path.join(path, _NODE_STORE_MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if columns is None:
+        columns = manifest['columns']
+    columns = [c for c in dict.fromkeys(columns) if c != 'node']
+    if any(c not in manifest['columns'] for c in columns):
+        return None
+
+    def _load(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+    with profile_stage('node store open', nodes=manifest['nodes']):
+        nodes = pd.DataFrame({c: _load('column_'
+                                       + str(manifest['columns'].index(c)))
+                              for c in columns},
+                             index=pd.Index(_load('node'), name='node'),
+                             copy=False)
+        return {'nodes': nodes, 'receiver_rows': _load('receiver_rows'),
+                'source': manifest['source']}
+
+
+##################
+# Network object #
+##################
+
+class Network(dict):
+    """
+    A segment network, holding the same keys as build_network returns (so
+    that it can be given to any function here that takes a network), with
+    the common operations on it as methods. For use in Python, e.g.:
+
+        network = Network.from_file('River_MChiSegmented.csv', basin_key=2)
+        path = network.downstream_path(network.headwaters()[0])
+        network.to_gpkg('River_network.gpkg')
+
+    Segment IDs are their row positions, as everywhere in this module.
+    """
+
+    @classmethod
+    def build(cls, node_table, attributes=SEGMENT_ATTRIBUTES,
+              fail_on_branching=False, jobs=1):
+        """
+        Build a network from a node table (see build_network). With jobs
+        above 1, the basins are built in parallel and merged (see
+        build_network_by_basin).
+        """
+        if jobs > 1:
+            return cls(build_network_by_basin(
+                        node_table, jobs=jobs, attributes=attributes,
+                        fail_on_branching=fail_on_branching))
+        return cls(build_network(node_table, attributes=attributes,
+                                 fail_on_branching=fail_on_branching))
+
+    @classmethod
+    def from_file(cls, path, basin_key=None, attributes=SEGMENT_ATTRIBUTES,
+                  columns=None, fail_on_branching=False, jobs=1):
+        """
+        Read an LSDTopoTools output (see read_node_table), for the given
+        basin(s) only if basin_key is set, and build its network. Only the
+        columns needed for the attributes are read unless columns is given.
+        Default attributes whose columns are not in the file are left out
+        (see available_attributes).
+        """
+        available_columns, _schema = node_table_columns(path)
+        attributes = available_attributes(attributes, available_columns)
+        if columns is None:
+            columns = network_columns(attributes, available_columns)
+        node_table = read_node_table(path, columns=columns,
+                                     basin_key=basin_key)
+        return cls.build(node_table, attributes=attributes,
+                         fail_on_branching=fail_on_branching, jobs=jobs)
+
+    @classmethod
+    def from_node_store(cls, path, basin_key=None,
+                        attributes=SEGMENT_ATTRIBUTES,
+                        fail_on_branching=False, jobs=1):
+        """
+        Build the network of the nodes in a node store (see
+        open_node_store), of the given basin(s) only if basin_key is set.
+        With jobs above 1, the worker processes share the store. Default
+        attributes whose columns are not in the store are left out.
+        """
+        store = open_node_store(path)
+        if store is None:
+            raise ValueError("No node store at " + path)
+        node_table = store['nodes']
+        attributes = available_attributes(
+                        attributes, ['node'] + list(node_table.columns))
+        if basin_key is not None:
+            node_table = node_table[node_table['basin_key'].isin(
+                                        np.atleast_1d(basin_key))]
+        if jobs > 1:
+            return cls(build_network_by_basin(
+                        node_table, jobs=jobs, node_store=path,
+                        attributes=attributes,
+                        fail_on_branching=fail_on_branching))
+        return cls(build_network(
+                    node_table, attributes=attributes,
+                    fail_on_branching=fail_on_branching,
+                    receiver_rows=None if basin_key is not None
+                                  else store['receiver_rows']))
+
+    @classmethod
+    def load(cls, path):
+        """A network from a cache entry (see load_network), or None."""
+        network = load_network(path)
+        return None if network is None else cls(network)
+
+    def save(self, path):
+        """Write the network to a cache entry (see save_network)."""
+        save_network(self, path)
+
+    @property
+    def segments(self):
+        """DataFrame of segment 'id', 'toseg' and attributes."""
+        return self['segments']
+
+    @property
+    def nodes(self):
+        """The node table, indexed by node ID."""
+        return self['nodes']
+
+    def select_basin(self, basin_key):
+        """The part of the network in one basin (see select_basin)."""
+        return type(self)(select_basin(self, basin_key))
+
+    def aggregate(self, attributes):
+        """
+        Further attributes of every segment (see aggregate_segments), as a
+        dict of output column -> array.
+        """
+        return aggregate_segments(self['nodes'], self['segment_rows'],
+                                  self['segment_offsets'], attributes)
+
+    def subdivide(self, reach_length, attributes=REACH_ATTRIBUTES):
+        """Split the segments into reaches (see subdivide_segments)."""
+        return subdivide_segments(self, reach_length, attributes)
+
+    def topology(self):
+        """
+        Upstream segments, stream orders and upstream channel length (see
+        upstream_topology).
+        """
+        length = self.aggregate([REACH_ATTRIBUTES[0]])['length [m]']
+        return upstream_topology(self['toseg'], length,
+                                 upstream=(self['upstream_offsets'],
+                                           self['upstream_ids']))
+
+    def headwaters(self):
+        """IDs of the segments that no other segment drains into."""
+        return headwater_rows(np.arange(len(self['toseg'])), self['toseg'])
+
+    def downstream_path(self, segment_id):
+        """IDs of the segments from segment_id down to the mouth."""
+        return downstream_path(self['toseg'], segment_id)
+
+    def downstream_paths(self, segment_ids):
+        """
+        The downstream paths from each of segment_ids, as (offsets, ids)
+        (see downstream_paths).
+        """
+        return downstream_paths(self['toseg'], segment_ids)
+
+    def to_gpkg(self, path, nodes_path=None, layer=None, **kwargs):
+        """Write the network to GeoPackage (see write_network)."""
+        write_network(self, path, nodes_path=nodes_path, layer=layer,
+                      **kwargs)
@@ -0,0 +1,628 @@
+"""
+Tests of lsdtt_network on small hand-built networks whose segments,
+links and orders can be worked out by eye.
+"""
+
+import os
+import sqlite3
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lsdtt_network
+
+
+def y_nodes():
+    """
+    A Y-shaped basin (basin 0): a main stem 10 -> 11 -> 12 -> 13 -> 14, its
+    mouth at 14 (which drains into itself), and a tributary 20 -> 21 that
+    joins it at 12. Nodes are 100 m apart along the flow.
+
+    Its segments are 0: 10-11-12 and 1: 20-21-12, both draining into
+    2: 12-13-14.
+    """
+    node = [10, 11, 12, 13, 14, 20, 21]
+    return pd.DataFrame({
+        'receiver_node': [11, 12, 13, 14, 14, 21, 12],
+        'source_key': [0, 0, 0, 0, 0, 1, 1],
+        'basin_key': [0] * 7,
+        'latitude': [45.] * 7,
+        'longitude': [-90., -90.001, -90.002, -90.003, -90.004,
+                      -90.001, -90.0015],
+        'elevation': [40., 30., 20., 10., 0., 35., 28.],
+        'flow_distance': [400., 300., 200., 100., 0., 400., 300.],
+        'drainage_area': [1E5, 2E5, 5E5, 6E5, 7E5, 1E5, 2E5],
+        'chi': [4., 3., 2., 1., 0., 4., 3.],
+        'm_chi': [30.] * 7,
+        }, index=pd.Index(node, name='node'))
+
+
+def single_node():
+    """A basin (basin 1) of one node, its own receiver."""
+    return pd.DataFrame({
+        'receiver_node': [99], 'source_key': [2], 'basin_key': [1],
+        'latitude': [46.], 'longitude': [-91.], 'elevation': [5.],
+        'flow_distance': [0.], 'drainage_area': [1E5], 'chi': [0.],
+        'm_chi': [30.],
+        }, index=pd.Index([99], name='node'))
+
+
+def two_basins():
+    return pd.concat([y_nodes(), single_node()])
+
+
+def segment_node_ids(network):
+    ids = network['nodes'].index.values
+    offsets = network['segment_offsets']
+    rows = network['segment_rows']
+    return [ids[rows[offsets[i]:offsets[i+1]]].tolist()
+            for i in range(len(offsets) - 1)]
+
+
+#################
+# Reading input #
+#################
+
+@pytest.fixture(params=['pyarrow', 'pandas'])
+def csv_reader(request, monkeypatch):
+    """Read CSV files with pyarrow, or with pandas as if pyarrow were not
+    installed."""
+    if request.param == 'pandas':
+        for name in ('pyarrow', 'pyarrow.compute', 'pyarrow.csv'):
+            monkeypatch.setitem(sys.modules, name, None)
+    else:
+        pytest.importorskip('pyarrow')
+    return request.param
+
+
+def test_read_node_table_basin_filter(tmp_path, csv_reader):
+    path = str(tmp_path / 'input_MChiSegmented.csv')
+    two_basins().to_csv(path)
+    node_table = lsdtt_network.read_node_table(path, columns=['elevation'],
+                                               basin_key=1, chunksize=2)
+    assert node_table.index.tolist() == [99]
+    assert list(node_table.columns) == ['elevation']
+    node_table = lsdtt_network.read_node_table(path, basin_key=[0, 1],
+                                               chunksize=2)
+    pd.testing.assert_frame_equal(node_table, two_basins(),
+                                  check_dtype=False)
+    assert node_table['basin_key'].dtype == np.int32
+
+
+def test_read_node_table_types_from_whole_file(tmp_path, csv_reader):
+    # Columns without a type of their own are typed from the whole file,
+    # not from the first block (or chunk) of it
+    lines = ['node,receiver_node,basin_key,count,ratio,label,gap,code']
+    lines += [str(i) + ',' + str(i) + ',0,' + str(i) + ',' + str(i)
+              + ',x,' + str(i) + ',' + str(i) for i in range(10)]
+    lines += ['10,10,0,3,2.5,,,A1']
+    path = tmp_path / 'input_MChiSegmented.csv'
+    path.write_text('\n'.join(lines) + '\n')
+    node_table = lsdtt_network.read_node_table(str(path), chunksize=4)
+    assert node_table['count'].dtype == np.int64
+    assert node_table['ratio'].dtype == np.float64
+    assert node_table['ratio'].iloc[-1] == 2.5
+    assert node_table['gap'].dtype == np.float64
+    assert np.isnan(node_table['gap'].iloc[-1])
+    assert node_table['label'].iloc[0] == 'x'
+    assert pd.isna(node_table['label'].iloc[-1])
+    # Numbers in a column of text are text too
+    assert node_table['code'].tolist() \
+        == [str(i) for i in range(10)] + ['A1']
+
+
+def test_read_chi_data_map(tmp_path, csv_reader):
+    # A chi_data_map names its node IDs NI and receiver_NI
+    path = str(tmp_path / 'input_chi_data_map.csv')
+    y_nodes().drop(columns='m_chi').rename_axis('NI') \
+             .rename(columns={'receiver_node': 'receiver_NI'}).to_csv(path)
+    columns, schema = lsdtt_network.node_table_columns(path)
+    assert schema == 'chi_data_map'
+    assert columns[:2] == ['node', 'receiver_node']
+    node_table = lsdtt_network.read_node_table(
+                    path, columns=['receiver_node', 'elevation'], basin_key=0)
+    assert node_table.index.name == 'node'
+    assert node_table['receiver_node'].tolist() \
+        == y_nodes()['receiver_node'].tolist()
+    network = lsdtt_network.build_network(
+                lsdtt_network.read_node_table(path),
+                attributes=lsdtt_network.available_attributes(
+                    lsdtt_network.SEGMENT_ATTRIBUTES, columns))
+    assert segment_node_ids(network) \
+        == [[10, 11, 12], [20, 21, 12], [12, 13, 14]]
+
+
+def test_detect_schema():
+    assert lsdtt_network.detect_schema(['node', 'receiver_node', 'chi']) \
+        == 'MChiSegmented'
+    assert lsdtt_network.detect_schema(['NI', 'receiver_NI', 'chi']) \
+        == 'chi_data_map'
+    with pytest.raises(ValueError):
+        lsdtt_network.detect_schema(['NI', 'receiver_node'])
+
+
+######################
+# Tracing and links  #
+######################
+
+def test_trace_segments_y():
+    # Rows of y_nodes: 10, 11, 12, 13, 14, 20, 21
+    receiver_rows = np.array([1, 2, 3, 4, -1, 6, 2])
+    is_termination = np.array([False, False, True, False, True,
+                               False, False])
+    offsets, rows = lsdtt_network.trace_segments(receiver_rows,
+                                                 is_termination, [0, 5, 2])
+    assert offsets.tolist() == [0, 3, 6, 9]
+    assert rows.tolist() == [0, 1, 2, 5, 6, 2, 2, 3, 4]
+
+
+def test_trace_segments_off_map():
+    with pytest.raises(ValueError):
+        lsdtt_network.trace_segments(np.array([1, -1]),
+                                     np.array([False, False]), [0])
+
+
+def test_resolve_toseg():
+    toseg, report = lsdtt_network.resolve_toseg([10, 20, 12], [12, 12, 14])
+    assert toseg.tolist() == [2, 2, -1]
+    assert report['mouths'].tolist() == [2]
+    assert report['branching'] == {}
+
+
+def test_resolve_toseg_branching():
+    # Segments 1 and 2 both start where segment 0 ends
+    toseg, report = lsdtt_network.resolve_toseg([1, 5, 5], [5, 9, 8])
+    assert toseg.tolist() == [1, -1, -1]
+    assert report['branching'] == {0: [1, 2]}
+    with pytest.raises(ValueError):
+        lsdtt_network.resolve_toseg([1, 5, 5], [5, 9, 8],
+                                    fail_on_branching=True)
+
+
+def test_build_network_y():
+    node_table = y_nodes()
+    network = lsdtt_network.build_network(node_table)
+    assert segment_node_ids(network) == [[10, 11, 12], [20, 21, 12],
+                                         [12, 13, 14]]
+    assert network['toseg'].tolist() == [2, 2, -1]
+    assert network['segments']['toseg'].tolist() == [2, 2, -1]
+    assert network['at_mouth'].tolist() == [False] * 4 + [True] \
+                                           + [False] * 2
+    assert network['nodes']['receiver_source_key'].tolist() \
+        == [0, 0, 0, 0, -1, 1, 0]
+    # The caller's table is left as it was
+    assert 'receiver_source_key' not in node_table.columns
+
+
+def test_build_network_single_node():
+    network = lsdtt_network.build_network(single_node())
+    assert network['toseg'].tolist() == [-1]
+    assert network['at_mouth'].tolist() == [True]
+    assert segment_node_ids(network) == [[99, 99]]
+
+
+def test_merge_networks_matches_single_build():
+    whole = lsdtt_network.build_network(two_basins())
+    networks = lsdtt_network.build_networks_by_basin(two_basins())
+    assert list(networks) == [0, 1]
+    merged = lsdtt_network.merge_networks(list(networks.values()))
+    for name in ('receiver_rows', 'at_mouth', 'segment_offsets',
+                 'segment_rows', 'toseg', 'upstream_offsets',
+                 'upstream_ids'):
+        assert np.array_equal(merged[name], whole[name]), name
+    pd.testing.assert_frame_equal(merged['segments'], whole['segments'])
+    pd.testing.assert_frame_equal(merged['nodes'], whole['nodes'])
+
+
+def test_select_basin():
+    whole = lsdtt_network.build_network(two_basins())
+    basin = lsdtt_network.select_basin(whole, 1)
+    assert segment_node_ids(basin) == [[99, 99]]
+    assert basin['toseg'].tolist() == [-1]
+
+
+def test_node_types():
+    network = lsdtt_network.build_network(two_basins())
+    types = lsdtt_network.node_types(len(network['nodes']),
+                                     network['channel_head_rows'],
+                                     network['confluence_rows'],
+                                     network['at_mouth'])
+    # The one-node basin's node is its own channel head and mouth
+    assert dict(zip(network['nodes'].index, types)) == {
+        10: 'channel head', 11: 'interior', 12: 'confluence',
+        13: 'interior', 14: 'mouth', 20: 'channel head', 21: 'interior',
+        99: 'mouth'}
+    # Mouths take precedence over confluences, and these over channel heads
+    assert lsdtt_network.node_types(3, [0, 1, 2], [1, 2],
+                                    [False, False, True]).tolist() \
+        == ['channel head', 'confluence', 'mouth']
+
+
+####################
+# Stream topology  #
+####################
+
+def test_upstream_topology_y():
+    topology = lsdtt_network.upstream_topology([2, 2, -1],
+                                               [200., 200., 200.])
+    assert topology['strahler'].tolist() == [1, 1, 2]
+    assert topology['shreve'].tolist() == [1, 1, 2]
+    assert topology['upstream_length'].tolist() == [200., 200., 600.]
+    assert topology['order'].tolist()[-1] == 2
+
+
+def test_upstream_topology_binary_tree():
+    # A full binary tree of 2**8 headwaters, wide enough to be taken a
+    # generation at a time: segment i drains into (i - 1) // 2
+    n_segments = 2**9 - 1
+    toseg = (np.arange(n_segments) - 1) // 2
+    toseg[0] = -1
+    topology = lsdtt_network.upstream_topology(toseg,
+                                               np.ones(n_segments))
+    assert topology['strahler'][0] == 9
+    assert topology['shreve'][0] == 2**8
+    assert topology['upstream_length'][0] == n_segments
+    assert set(topology['strahler'][2**8 - 1:].tolist()) == {1}
+
+
+def test_upstream_topology_deep_trunk():
+    # A trunk of n segments, 0 -> 1 -> ... -> n-1, each below the first
+    # joined by a headwater tributary n-1+i
+    n = 5000
+    toseg = np.concatenate((np.arange(1, n), [-1], np.arange(1, n)))
+    topology = lsdtt_network.upstream_topology(toseg, np.ones(len(toseg)))
+    trunk = np.arange(n)
+    assert topology['strahler'][trunk].tolist() == [1] + [2] * (n - 1)
+    assert topology['shreve'][trunk].tolist() == (trunk + 1).tolist()
+    assert topology['upstream_length'][trunk].tolist() \
+        == (2 * trunk + 1).tolist()
+    assert sorted(topology['order'].tolist()) == list(range(len(toseg)))
+
+
+def test_upstream_topology_loop():
+    with pytest.raises(ValueError):
+        lsdtt_network.upstream_topology([1, 0], [1., 1.])
+
+
+def test_downstream_paths_shared_suffixes():
+    # A binary tree: 0, 1 -> 4; 2, 3 -> 5; 4, 5 -> 6, the mouth. Paths
+    # that join an earlier one (or start on it) reuse the rest of it
+    toseg = np.array([4, 4, 5, 5, 6, 6, -1])
+    starts = [0, 1, 2, 6, 4, 0]
+    offsets, rows = lsdtt_network.downstream_paths(toseg, starts)
+    paths = [rows[offsets[i]:offsets[i+1]].tolist()
+             for i in range(len(starts))]
+    assert paths == [[0, 4, 6], [1, 4, 6], [2, 5, 6], [6], [4, 6],
+                     [0, 4, 6]]
+    assert paths == [lsdtt_network.downstream_path(toseg, _start).tolist()
+                     for _start in starts]
+    assert lsdtt_network.downstream_paths(toseg, [])[0].tolist() == [0]
+
+
+def test_downstream_paths_loop():
+    with pytest.raises(ValueError):
+        lsdtt_network.downstream_paths(np.array([1, 2, 0]), [0])
+
+
+#######################
+# Segment attributes  #
+#######################
+
+def test_aggregate_segments_y():
+    network = lsdtt_network.build_network(y_nodes(), attributes=[])
+    attributes = [a for a in lsdtt_network.SEGMENT_ATTRIBUTES
+                  if a[0] in ('slope', 'z mean', 'drainage area (mean) [km2]')]
+    attributes += [lsdtt_network.parse_attribute('elevation:first'),
+                   lsdtt_network.parse_attribute('chi:sum')]
+    values = lsdtt_network.aggregate_segments(
+                network['nodes'], network['segment_rows'],
+                network['segment_offsets'], attributes)
+    assert list(values) == ['slope', 'z mean', 'drainage area (mean) [km2]',
+                            'elevation (first)', 'chi (sum)']
+    # Segments 0: 10-11-12, 1: 20-21-12 and 2: 12-13-14
+    np.testing.assert_allclose(values['slope'], [0.1, 0.075, 0.1])
+    np.testing.assert_allclose(values['z mean'], [30., 83. / 3, 10.])
+    np.testing.assert_allclose(values['drainage area (mean) [km2]'],
+                               [0.8 / 3, 0.8 / 3, 0.6])
+    assert values['elevation (first)'].tolist() == [40., 35., 20.]
+    assert values['chi (sum)'].tolist() == [9., 9., 3.]
+
+
+def test_parse_attribute():
+    assert lsdtt_network.parse_attribute('depth_to_bedrock') \
+        == ('depth_to_bedrock (mean)', 'depth_to_bedrock', 'mean', 1.)
+    assert lsdtt_network.parse_attribute('elevation:range') \
+        == ('elevation (range)', 'elevation', 'range', 1.)
+    # gradient needs two columns, so it cannot be asked for this way
+    for spec in ('elevation:median', 'elevation:gradient'):
+        with pytest.raises(ValueError):
+            lsdtt_network.parse_attribute(spec)
+
+
+##############
+# Reaches    #
+##############
+
+def test_subdivide_segments_at_segment_boundary():
+    # Every segment is 200 m long, so 100 m reaches split each one in two,
+    # and the last reach of each ends exactly at the segment's end
+    network = lsdtt_network.build_network(y_nodes())
+    reaches = lsdtt_network.subdivide_segments(
+                network, 100., [lsdtt_network.REACH_ATTRIBUTES[0]])
+    df = reaches['reaches']
+    assert df['segment_id'].tolist() == [0, 0, 1, 1, 2, 2]
+    assert df['from_node'].tolist() == [10, 11, 20, 21, 12, 13]
+    assert df['to_node'].tolist() == [11, 12, 21, 12, 13, 14]
+    assert df['toreach'].tolist() == [1, 4, 3, 4, 5, -1]
+    assert df['length [m]'].tolist() == [100.] * 6
+
+
+def test_subdivide_segments_one_reach():
+    network = lsdtt_network.build_network(y_nodes())
+    reaches = lsdtt_network.subdivide_segments(
+                network, 200., [lsdtt_network.REACH_ATTRIBUTES[0]])
+    df = reaches['reaches']
+    assert df['from_node'].tolist() == [10, 20, 12]
+    assert df['to_node'].tolist() == [12, 12, 14]
+    assert df['toreach'].tolist() == [2, 2, -1]
+    assert np.array_equal(reaches['reach_offsets'],
+                          network['segment_offsets'])
+
+
+def test_default_reach_attributes_without_m_chi(tmp_path):
+    # As from a chi_data_map, which has no m_chi: reaches, like segments,
+    # leave out ksn
+    node_table = y_nodes().drop(columns='m_chi')
+    network = lsdtt_network.Network.build(
+                node_table, attributes=lsdtt_network.available_attributes(
+                    lsdtt_network.SEGMENT_ATTRIBUTES,
+                    ['node'] + list(node_table.columns)))
+    reaches = network.subdivide(200.)['reaches']
+    assert 'ksn' not in reaches.columns
+    assert reaches['length [m]'].tolist() == [200.] * 3
+    path = str(tmp_path / 'network.gpkg')
+    network.to_gpkg(path, reach_length=200.)
+    assert lsdtt_network.read_gpkg_metadata(path, 'reaches')['reaches'] \
+        == '3'
+
+
+#####################
+# GeoPackage files  #
+#####################
+
+def test_read_gpkg_part(tmp_path, monkeypatch):
+    path = str(tmp_path / 'network.gpkg')
+    network = lsdtt_network.Network.build(two_basins())
+    network.to_gpkg(path)
+    toseg = network['toseg']
+    cache_dir = str(tmp_path / 'cache')
+    # Straight from the GeoPackage, then through the cache as its
+    # GeoParquet copy is made, and then from that copy
+    for _cache_dir in (None, cache_dir, cache_dir):
+        if _cache_dir is not None and os.path.isdir(cache_dir):
+            assert [f for f in os.listdir(cache_dir)
+                    if f.endswith('.parquet')]
+            monkeypatch.setattr(lsdtt_network, 'read_gpkg_cached', None)
+        # Columns that the layer lacks are left out
+        gdf = lsdtt_network.read_gpkg(path, columns=['toseg', 'missing'],
+                                      ids=[2, 0], cache_dir=_cache_dir)
+        assert sorted(gdf.columns) == ['geometry', 'id', 'toseg']
+        assert gdf['id'].tolist() == [0, 2]
+        assert gdf['toseg'].tolist() == toseg[[0, 2]].tolist()
+        df = lsdtt_network.read_gpkg(path, columns=['toseg'], ids=[3],
+                                     read_geometry=False,
+                                     cache_dir=_cache_dir)
+        assert type(df) is pd.DataFrame
+        assert df[['id', 'toseg']].values.tolist() == [[3, toseg[3]]]
+
+
+def test_gpkg_indexes_and_metadata(tmp_path):
+    path = str(tmp_path / 'network.gpkg')
+    nodes_path = str(tmp_path / 'network_nodes.gpkg')
+    lsdtt_network.Network.build(two_basins()).to_gpkg(
+        path, nodes_path=nodes_path, metadata={'source_file': 'input.csv'})
+    for _path, columns in ((path, ['id', 'toseg', 'strahler']),
+                           (nodes_path, ['segment_id', 'node'])):
+        con = sqlite3.connect(_path)
+        try:
+            indexed = [row[0] for row in con.execute(
+                          "SELECT sql FROM sqlite_master WHERE type = 'index'"
+                          " AND name LIKE 'idx_%'")]
+        finally:
+            con.close()
+        assert len(indexed) == len(columns)
+        assert all(any('("' + c + '")' in sql for sql in indexed)
+                   for c in columns)
+        metadata = lsdtt_network.read_gpkg_metadata(_path)
+        assert metadata['source_file'] == 'input.csv'
+        assert metadata['segments'] == '4'
+        assert metadata['nodes'] == '8'
+        assert metadata['basin_keys'] == '0,1'
+    # Later values replace earlier ones, layer by layer
+    lsdtt_network.write_gpkg_metadata(path, None, {'segments': 5})
+    lsdtt_network.write_gpkg_metadata(path, 'other', {'segments': 6})
+    assert lsdtt_network.read_gpkg_metadata(path)['segments'] == '5'
+    assert lsdtt_network.read_gpkg_metadata(path, 'other') \
+        == {'segments': '6'}
+    assert lsdtt_network.read_gpkg_metadata(path, 'none') == {}
+    assert lsdtt_network.read_gpkg_metadata(str(tmp_path / 'none.gpkg')) \
+        == {}
+
+
+###########################
+# Incremental and caches  #
+###########################
+
+def test_basin_digests():
+    digests = lsdtt_network.basin_digests(two_basins())
+    assert list(digests) == [0, 1]
+    assert digests == lsdtt_network.basin_digests(two_basins())
+    changed = two_basins()
+    changed.loc[13, 'elevation'] = 11.
+    changed_digests = lsdtt_network.basin_digests(changed)
+    assert changed_digests[0] != digests[0]
+    assert changed_digests[1] == digests[1]
+    # Columns left out of the digest do not count
+    assert lsdtt_network.basin_digests(changed, ['receiver_node']) \
+        == lsdtt_network.basin_digests(two_basins(), ['receiver_node'])
+
+
+def test_network_cache_round_trip(tmp_path):
+    network = lsdtt_network.build_network(two_basins())
+    path = str(tmp_path / 'cache' / 'entry.npz')
+    lsdtt_network.save_network(network, path)
+    loaded = lsdtt_network.load_network(path)
+    for name in lsdtt_network._NETWORK_ARRAYS:
+        assert np.array_equal(loaded[name], network[name]), name
+    pd.testing.assert_frame_equal(loaded['segments'], network['segments'])
+    pd.testing.assert_frame_equal(loaded['nodes'], network['nodes'])
+    assert loaded['report']['mouths'].tolist() \
+        == network['report']['mouths'].tolist()
+    assert lsdtt_network.load_network(str(tmp_path / 'missing.npz')) \
+        is None
+
+
+def test_network_cache_path(tmp_path):
+    file_input = tmp_path / 'input.csv'
+    file_input.write_text('node\n1\n')
+    cache_dir = str(tmp_path / 'cache')
+    path = lsdtt_network.network_cache_path(cache_dir, str(file_input),
+                                            basin_key=None)
+    assert path == lsdtt_network.network_cache_path(
+                    cache_dir, str(file_input), basin_key=None)
+    assert path != lsdtt_network.network_cache_path(
+                    cache_dir, str(file_input), basin_key=1)
+    file_input.write_text('node\n2\n')
+    assert path != lsdtt_network.network_cache_path(
+                    cache_dir, str(file_input), basin_key=None)
+
+
+def test_evict_cache(tmp_path):
+    cache_dir = tmp_path
+    entries = [cache_dir / (c * 40 + '.npz') for c in 'abc']
+    for i, entry in enumerate(entries):
+        entry.write_bytes(b'x' * 100)
+        os.utime(entry, (i, i))
+    other = cache_dir / 'my_results.npz'
+    other.write_bytes(b'x' * 1000)
+    os.utime(other, (0, 0))
+    # The oldest entry is kept, so the next oldest goes instead
+    lsdtt_network.evict_cache(str(cache_dir), 200, keep=[str(entries[0])])
+    assert [e.exists() for e in entries] == [True, False, True]
+    assert other.exists()
+    lsdtt_network.evict_cache(str(cache_dir), 0, keep=[str(entries[2])])
+    assert [e.exists() for e in entries] == [False, False, True]
+    assert other.exists()
+
+
+def test_node_store_round_trip(tmp_path):
+    node_table = two_basins()
+    path = str(tmp_path / 'store')
+    lsdtt_network.save_node_store(node_table, path, source={'a': 1})
+    store = lsdtt_network.open_node_store(path)
+    # The columns are memory-mapped: compare them as plain arrays
+    pd.testing.assert_frame_equal(
+        store['nodes'].apply(lambda column: np.array(column)), node_table)
+    assert store['receiver_rows'].tolist() == [1, 2, 3, 4, 4, 6, 2, 7]
+    assert store['source'] == {'a': 1}
+    store = lsdtt_network.open_node_store(path, ['elevation'])
+    assert list(store['nodes'].columns) == ['elevation']
+    assert lsdtt_network.open_node_store(path, ['missing']) is None
+    assert lsdtt_network.open_node_store(str(tmp_path / 'none')) is None
+
+
+def test_node_store_replace_keeps_other_files(tmp_path):
+    path = tmp_path / 'store'
+    lsdtt_network.save_node_store(two_basins(), str(path), source=1)
+    (path / 'notes.txt').write_text('keep me')
+    lsdtt_network.save_node_store(y_nodes(), str(path), source=2)
+    store = lsdtt_network.open_node_store(str(path))
+    assert store['source'] == 2
+    assert len(store['nodes']) == 7
+    assert (path / 'notes.txt').read_text() == 'keep me'
+    assert sorted(os.listdir(tmp_path)) == ['store']
+
+
+def test_node_store_refuses_other_directory(tmp_path):
+    path = tmp_path / 'data'
+    path.mkdir()
+    (path / 'input.csv').write_text('node\n1\n')
+    with pytest.raises(ValueError):
+        lsdtt_network.save_node_store(y_nodes(), str(path))
+    assert os.listdir(path) == ['input.csv']
+    # An empty directory is fine
+    empty = tmp_path / 'empty'
+    empty.mkdir()
+    lsdtt_network.save_node_store(y_nodes(), str(empty))
+    assert lsdtt_network.open_node_store(str(empty)) is not None
+
+
+def test_read_node_table_digest(tmp_path):
+    path = str(tmp_path / 'input_MChiSegmented.csv')
+    two_basins().to_csv(path)
+    node_table, digest = lsdtt_network.read_node_table(
+                            path, columns=['receiver_node'], basin_key=1,
+                            return_digest=True)
+    # The digest is of the whole file, however little of it is kept
+    assert digest == lsdtt_network.file_digest(path, None)
+    assert node_table.index.tolist() == [99]
+    assert list(node_table.columns) == ['receiver_node']
+    # and a node store keeps it with the source
+    store = str(tmp_path / 'store')
+    lsdtt_network.save_node_store(node_table, store,
+                                  source={'source_blake2b': digest})
+    assert lsdtt_network.open_node_store(store)['source'] \
+        == {'source_blake2b': digest}
+
+
+NETWORK_TOOL = os.path.join(os.path.dirname(os.path.dirname(
+                   os.path.abspath(__file__))), 'lsdtt-network-tool.py')
+
+
+def run_network_tool(*args):
+    """Run lsdtt-network-tool.py, returning what it prints."""
+    return subprocess.run([sys.executable, NETWORK_TOOL] + list(args),
+                          check=True, capture_output=True,
+                          text=True).stdout
+
+
+def test_incremental(tmp_path):
+    file_input = str(tmp_path / 'input_MChiSegmented.csv')
+    file_output = str(tmp_path / 'network.gpkg')
+    two_basins().to_csv(file_input)
+    # One layer per basin
+    run_network_tool(file_input, file_output, '--basin_key', 'all-separate')
+    out = run_network_tool(file_input, file_output, '--basin_key',
+                           'all-separate', '--incremental')
+    assert 'Basin 0: unchanged' in out and 'Basin 1: unchanged' in out
+    changed = two_basins()
+    changed.loc[99, 'elevation'] = 6.
+    changed.to_csv(file_input)
+    out = run_network_tool(file_input, file_output, '--basin_key',
+                           'all-separate', '--incremental')
+    assert 'Basin 0: unchanged' in out and 'Basin 1: unchanged' not in out
+    assert 'Basin 1:' in out
+    # Unchanged outputs are kept, with the source file brought up to date
+    digest = lsdtt_network.file_digest(file_input, None)
+    for layer in ('basin_0', 'basin_1'):
+        assert lsdtt_network.read_gpkg_metadata(file_output, layer)[
+                   'source_blake2b'] == digest
+    # A single network is left alone only if none of its basins has
+    # changed, and with the same options
+    file_output = str(tmp_path / 'whole.gpkg')
+    run_network_tool(file_input, file_output)
+    assert 'No basin has changed' in run_network_tool(
+                                        file_input, file_output,
+                                        '--incremental')
+    assert 'No basin has changed' not in run_network_tool(
+                                            file_input, file_output,
+                                            '--incremental',
+                                            '--reach_length', '100')
+    two_basins().to_csv(file_input)
+    assert 'No basin has changed' not in run_network_tool(
+                                            file_input, file_output,
+                                            '--incremental',
+                                            '--reach_length', '100')